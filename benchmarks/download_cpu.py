@@ -0,0 +1,67 @@
+"""
+Measure the client CPU time per GiB downloaded by CustomFetcher with fixed 4 KiB
+chunks and in adaptive mode, from a local server with no bandwidth limit.
+
+    python benchmarks/download_cpu.py --size-mb 256 --runs 3
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from network_download import CustomFetcher  # noqa: E402
+from throttled_server import ThrottledServer  # noqa: E402
+
+CASES = [
+    ("chunk_size=4096", {}),
+    ("chunk_size=65536", {"chunk_size": 64 * 1024}),
+    ("adaptive", {"adaptive": True}),
+]
+
+
+def timed_fetch(fetcher, url, length, write_to=None):
+    """
+    Fetch url, optionally writing it to a file as ngclient does. Returns the CPU
+    seconds of this thread (the server threads are not counted), wall seconds and
+    the number of chunks.
+    """
+    chunks = received = 0
+    cpu_started, started = time.thread_time(), time.perf_counter()
+    for chunk in fetcher.fetch(url):
+        received += len(chunk)
+        chunks += 1
+        if write_to is not None:
+            write_to.write(chunk)
+    cpu, wall = time.thread_time() - cpu_started, time.perf_counter() - started
+    assert received == length, f"received {received} of {length} bytes"
+    return cpu, wall, chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=256)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--write", action="store_true", help="Also write the body to a temporary file")
+    args = parser.parse_args()
+
+    payload = os.urandom(int(args.size_mb * 1024 * 1024))
+    gib = len(payload) / 2**30
+    with ThrottledServer(payload, chunk_size=1024 * 1024) as server:
+        print(f"{len(payload) / 2**20:.0f} MiB, median of {args.runs} runs, client thread CPU only")
+        for name, options in CASES:
+            fetcher = CustomFetcher(**options)
+            runs = []
+            for _ in range(args.runs):
+                with tempfile.TemporaryFile() as temp_file:
+                    runs.append(timed_fetch(fetcher, server.url, len(payload), temp_file if args.write else None))
+            cpu, wall, chunks = (statistics.median(values) for values in zip(*runs))
+            print(f"{name:<18} {cpu / gib:6.2f} CPU s/GiB  {len(payload) / wall / 2**20:8.1f} MiB/s  "
+                  f"{chunks:8.0f} chunks")
+
+
+if __name__ == "__main__":
+    main()
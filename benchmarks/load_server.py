@@ -0,0 +1,100 @@
+"""
+Measure how a running server copes with many slow downloads at once.
+
+Starts --slow-clients downloads of a target that each read at most --client-kbps,
+and meanwhile times small metadata requests. Run it once against the Flask server
+under gunicorn and once against the asyncio server under uvicorn, with the same
+number of workers, to compare them:
+
+    gunicorn -w 4 -b 0.0.0.0:8000 server_host:app
+    uvicorn server_async:app --port 8001 --workers 4
+    python benchmarks/load_server.py http://localhost:8000/targets/<sha256>.app.exe \\
+        --probe http://localhost:8000/metadata/timestamp.json
+"""
+import argparse
+import statistics
+import threading
+import time
+
+import requests
+
+
+def slow_download(url, rate, results):
+    started = time.perf_counter()
+    received = 0
+    try:
+        with requests.get(url, stream=True, timeout=300) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(16 * 1024):
+                received += len(chunk)
+                # Sleep off whatever the client is ahead of its rate
+                ahead = received / rate - (time.perf_counter() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        results.append((time.perf_counter() - started, received))
+    except requests.RequestException as e:
+        results.append((None, str(e)))
+
+
+def probe_latencies(url, stop, latencies, errors):
+    session = requests.Session()
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            session.get(url, timeout=30).raise_for_status()
+            latencies.append(time.perf_counter() - started)
+        except requests.RequestException:
+            errors.append(time.perf_counter() - started)
+        time.sleep(0.05)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("url", help="Target URL the slow clients download")
+    parser.add_argument("--probe", help="Small URL timed while the downloads run, e.g. timestamp.json")
+    parser.add_argument("--slow-clients", type=int, default=64)
+    parser.add_argument("--client-kbps", type=float, default=256, help="Per-client read rate in KiB/s")
+    args = parser.parse_args()
+
+    downloads, latencies, errors = [], [], []
+    stop = threading.Event()
+    prober = None
+    if args.probe:
+        prober = threading.Thread(target=probe_latencies, args=(args.probe, stop, latencies, errors))
+        prober.start()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=slow_download, args=(args.url, args.client_kbps * 1024, downloads))
+               for _ in range(args.slow_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    if prober:
+        prober.join()
+
+    finished = [seconds for seconds, _ in downloads if seconds is not None]
+    failed = [error for seconds, error in downloads if seconds is None]
+    print(f"{args.slow_clients} slow clients at {args.client_kbps:g} KiB/s, wall time {elapsed:.1f} s")
+    if finished:
+        total = sum(size for seconds, size in downloads if seconds is not None)
+        print(f"downloads: {len(finished)} ok, {len(failed)} failed, median {statistics.median(finished):.1f} s, "
+              f"max {max(finished):.1f} s, {total / elapsed / 2**20:.2f} MiB/s served")
+    for error in failed[:3]:
+        print(f"  failed: {error}")
+    if latencies:
+        print(f"probe: {len(latencies)} ok, {len(errors)} failed, p50 {percentile(latencies, 0.5) * 1000:.0f} ms, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.0f} ms, max {max(latencies) * 1000:.0f} ms")
+    elif args.probe:
+        print(f"probe: no request completed, {len(errors)} failed")
+
+
+if __name__ == "__main__":
+    main()
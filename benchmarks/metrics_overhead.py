@@ -0,0 +1,86 @@
+"""
+Measure what the metrics of server_host.py cost per request: the same requests
+through Flask's test client (no network) with METRICS_ENABLED=1 and =0, each in a
+fresh interpreter on a temporary local storage. The two alternate --repeat times and
+the fastest round of each counts, which keeps noise from other processes out.
+
+    python benchmarks/metrics_overhead.py --requests 20000 --repeat 3
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run with cwd set to the storage directory and the number of requests as argument,
+# prints the microseconds per request of each case
+CLIENT = r"""
+import hashlib, sys, time
+requests = int(sys.argv[1])
+sys.argv = [sys.argv[0]]
+import server_host
+from server_storage import put_file
+
+payload = b"x" * (256 * 1024)
+sha256 = hashlib.sha256(payload).hexdigest()
+put_file(server_host.storage, "metadata/timestamp.json", b'{"signed": {}}')
+put_file(server_host.storage, f"targets/{sha256}.app.exe", payload)
+server_host.logger.disabled = True
+client = server_host.app.test_client()
+cases = [("metadata (cache hit)", "/metadata/timestamp.json"), ("target 256 KiB", f"/targets/{sha256}.app.exe")]
+for name, url in cases:
+    rounds = []
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(requests // 5):
+            client.get(url).close()
+        rounds.append((time.perf_counter() - started) / (requests // 5) * 1e6)
+    print(name, min(rounds))
+
+if server_host.METRICS_ENABLED:
+    # The request hooks on their own, for a target response
+    response = client.get(cases[1][1])
+    response.close()
+    with server_host.app.test_request_context(cases[1][1]):
+        rounds = []
+        for _ in range(5):
+            started = time.perf_counter()
+            for _ in range(requests // 5):
+                server_host.start_request_timer()
+                server_host.record_request(response)
+            rounds.append((time.perf_counter() - started) / (requests // 5) * 1e6)
+    print("request hooks alone", min(rounds))
+"""
+
+
+def run(requests, enabled, storage_dir):
+    env = {**os.environ, "PYTHONPATH": REPO_ROOT, "STORAGE_BACKEND": "local", "STORAGE_DIR": storage_dir,
+           "METRICS_ENABLED": "1" if enabled else "0"}
+    output = subprocess.run([sys.executable, "-c", CLIENT, str(requests)], cwd=storage_dir, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    return {name: float(value) for name, _, value in (line.rpartition(" ") for line in output.splitlines())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    disabled, enabled = {}, {}
+    with tempfile.TemporaryDirectory() as storage_dir:
+        for _ in range(args.repeat):
+            for enable, results in ((False, disabled), (True, enabled)):
+                for name, elapsed in run(args.requests, enable, storage_dir).items():
+                    results[name] = min(elapsed, results.get(name, elapsed))
+    print(f"{'':<22} {'metrics off':>12} {'metrics on':>12} {'overhead':>10}")
+    for name in disabled:
+        off, on = disabled[name], enabled[name]
+        print(f"{name:<22} {off:9.1f} us {on:9.1f} us {on - off:7.1f} us ({(on - off) / off:+.1%})")
+    print(f"{'request hooks alone':<22} {'':>12} {enabled['request hooks alone']:9.1f} us")
+
+
+if __name__ == "__main__":
+    main()
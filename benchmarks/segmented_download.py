@@ -0,0 +1,49 @@
+"""
+Compare single-stream and segmented CustomFetcher downloads over a throttled local link.
+
+    python benchmarks/segmented_download.py --size-mb 24 --rate-mbps 4
+"""
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from network_download import CustomFetcher  # noqa: E402
+from throttled_server import ThrottledServer  # noqa: E402
+
+
+def timed_download(url, length, segments):
+    fetcher = CustomFetcher(chunk_size=64 * 1024, segments=segments)
+    started = time.perf_counter()
+    with fetcher.download_file(url, length) as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return time.perf_counter() - started, digest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=24)
+    parser.add_argument("--rate-mbps", type=float, default=4, help="Per-connection limit in MB/s")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before each response")
+    parser.add_argument("--segments", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    payload = os.urandom(int(args.size_mb * 1024 * 1024))
+    expected = hashlib.sha256(payload).hexdigest()
+
+    with ThrottledServer(payload, int(args.rate_mbps * 1024 * 1024), args.latency) as server:
+        baseline = None
+        print(f"{len(payload) / 2**20:.1f} MiB at {args.rate_mbps} MB/s per connection")
+        for segments in args.segments:
+            elapsed, digest = timed_download(server.url, len(payload), segments)
+            assert digest == expected, "downloaded bytes differ from the payload"
+            baseline = baseline or elapsed
+            print(f"segments={segments:<3} {elapsed:6.2f} s  {len(payload) / elapsed / 2**20:7.2f} MiB/s  "
+                  f"speedup x{baseline / elapsed:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Local HTTP server serving an in-memory payload with single-range support and an
+optional per-connection bandwidth limit, used to simulate a slow link in benchmarks.
+"""
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RANGE = re.compile(r"bytes=(\d+)-(\d*)$")
+
+
+class ThrottledServer:
+    def __init__(self, payload: bytes, bytes_per_second=None, latency=0.0, chunk_size=16 * 1024):
+        self.payload = payload
+        self.bytes_per_second = bytes_per_second  # per connection, None for unlimited
+        self.latency = latency  # seconds added before every response
+        self.chunk_size = chunk_size
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/payload"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                payload = server.payload
+                start, stop = 0, len(payload)
+                match = RANGE.match(self.headers.get("Range", ""))
+                if match:
+                    start = int(match.group(1))
+                    stop = min(int(match.group(2)) + 1 if match.group(2) else stop, len(payload))
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{stop - 1}/{len(payload)}")
+                else:
+                    self.send_response(200)
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Content-Length", str(stop - start))
+                self.end_headers()
+
+                time.sleep(server.latency)
+                view = memoryview(payload)
+                began = time.perf_counter()
+                sent = 0
+                try:
+                    for offset in range(start, stop, server.chunk_size):
+                        chunk = view[offset:min(offset + server.chunk_size, stop)]
+                        self.wfile.write(chunk)
+                        sent += len(chunk)
+                        if server.bytes_per_second:
+                            ahead = sent / server.bytes_per_second - (time.perf_counter() - began)
+                            if ahead > 0:
+                                time.sleep(ahead)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up on the response, e.g. after a length mismatch
+                    self.close_connection = True
+
+        return Handler
@@ -0,0 +1,100 @@
+"""
+Measure the updater's "no update" check: the full TUF check against the fast path
+of update_check.py, each in a fresh interpreter as the updater executable runs.
+
+    python benchmarks/updater_startup.py --runs 10
+"""
+import argparse
+import functools
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from securesystemslib.signer import CryptoSigner
+from tuf.api.metadata import Metadata, MetaFile, Root, Snapshot, TargetFile, Targets, Timestamp
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGET = "targets/color_changer.exe"
+
+FULL_CHECK = "from tuf_client import init_tofu, download; init_tofu({url!r}); download({url!r}, {target!r}, interactive=False)"
+FAST_CHECK = "from update_check import is_up_to_date; assert is_up_to_date({url!r}, {target!r})"
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def write_repository(directory, payload):
+    """
+    Publish a one-target repository in directory, laid out as server_host.py serves it.
+    """
+    signer = CryptoSigner.generate_ecdsa()
+    expires = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(days=1)
+    target_file = TargetFile.from_data(TARGET, payload)
+    roles = {
+        "root": Root(expires=expires),
+        "targets": Targets(expires=expires, targets={TARGET: target_file}),
+        "snapshot": Snapshot(expires=expires, meta={"targets.json": MetaFile(1)}),
+        "timestamp": Timestamp(expires=expires, snapshot_meta=MetaFile(1)),
+    }
+    for role in roles:
+        roles["root"].add_key(signer.public_key, role)
+
+    os.makedirs(os.path.join(directory, "metadata"))
+    os.makedirs(os.path.join(directory, "targets"))
+    for role, signed in roles.items():
+        metadata = Metadata(signed)
+        metadata.sign(signer)
+        name = "timestamp.json" if role == "timestamp" else f"1.{role}.json"
+        metadata.to_file(os.path.join(directory, "metadata", name))
+    with open(os.path.join(directory, "targets", f"{target_file.hashes['sha256']}.color_changer.exe"), "wb") as f:
+        f.write(payload)
+
+
+def timed_run(code, cwd):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=cwd, check=True, stdout=subprocess.DEVNULL,
+                   env={**os.environ, "PYTHONPATH": REPO_ROOT})
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--size-mb", type=float, default=20, help="Size of the installed target")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as repository, tempfile.TemporaryDirectory() as client:
+        write_repository(repository, os.urandom(int(args.size_mb * 1024 * 1024)))
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=repository))
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{httpd.server_address[1]}"
+
+        # Download the target, then let a full check find it up to date and record that
+        full_check = FULL_CHECK.format(url=url, target=TARGET)
+        for _ in range(2):
+            timed_run(full_check, client)
+
+        cases = [
+            ("interpreter", "pass"),
+            ("import tuf_client", "import tuf_client"),
+            ("import update_check", "import update_check"),
+            ("full TUF check", full_check),
+            ("fast check", FAST_CHECK.format(url=url, target=TARGET)),
+        ]
+        print(f"Median of {args.runs} runs, {args.size_mb:g} MiB target installed")
+        for name, code in cases:
+            elapsed = statistics.median(timed_run(code, client) for _ in range(args.runs))
+            print(f"{name:<20} {elapsed * 1000:8.1f} ms")
+        httpd.shutdown()
+
+
+if __name__ == "__main__":
+    main()
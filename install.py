@@ -0,0 +1,114 @@
+"""
+Atomic installs with a history of previous versions.
+
+activate() puts a new version in place with a single rename on the same volume, so
+the installed file is always either the complete old or the complete new version and
+no bytes are copied. The replaced version stays available in PREVIOUS_DIR through a
+hard link (or is moved there where links are not supported), the last KEEP_VERSIONS
+of them, and rollback() renames the newest one back. reject() records the hash of a
+version that was rolled back, so that the updater does not install it again.
+"""
+import hashlib
+import os
+
+PREVIOUS_DIR = "previous_versions"  # Next to the installed file
+KEEP_VERSIONS = int(os.getenv("KEEP_VERSIONS", 3))
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def install_path(target_path, install_dir):
+    """
+    Where target "targets/<path>" is installed: <install_dir>/<path>.
+    """
+    return os.path.join(os.path.abspath(install_dir), *target_path.split("/")[1:])
+
+
+def previous_versions(destination):
+    """
+    Paths of the kept versions of destination, newest first.
+    """
+    name = os.path.basename(destination)
+    directory = os.path.join(os.path.dirname(os.path.abspath(destination)), PREVIOUS_DIR)
+    try:
+        entries = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    versions = []
+    for entry in entries:
+        prefix, _, number = entry.rpartition(".")
+        if prefix == name and number.isdigit():
+            versions.append((int(number), os.path.join(directory, entry)))
+    return [path for _, path in sorted(versions, reverse=True)]
+
+
+def keep_version(destination, keep=KEEP_VERSIONS):
+    """
+    Keep the installed destination as <PREVIOUS_DIR>/<name>.<n> and drop the versions
+    beyond the newest keep.
+    """
+    versions = previous_versions(destination)
+    number = int(versions[0].rpartition(".")[2]) + 1 if versions else 1
+    directory = os.path.join(os.path.dirname(os.path.abspath(destination)), PREVIOUS_DIR)
+    os.makedirs(directory, exist_ok=True)
+    kept_path = os.path.join(directory, f"{os.path.basename(destination)}.{number}")
+    try:
+        os.link(destination, kept_path)
+    except OSError:
+        # No hard links (e.g. FAT): move it, the name is missing until the new version is renamed in
+        os.replace(destination, kept_path)
+    for old_path in ([kept_path] + versions)[keep:]:
+        os.remove(old_path)
+
+
+def activate(new_path, destination, keep=KEEP_VERSIONS):
+    """
+    Rename new_path, a complete and verified file on the same volume, onto destination.
+    Raises PermissionError while destination is running on Windows.
+    """
+    if keep > 0 and os.path.exists(destination):
+        keep_version(destination, keep)
+    os.replace(new_path, destination)
+
+
+def rollback(destination):
+    """
+    Put the newest kept version back in place. Returns False if there is none.
+    """
+    versions = previous_versions(destination)
+    if not versions:
+        return False
+    os.replace(versions[0], destination)
+    return True
+
+
+def rejected_path(destination):
+    directory = os.path.join(os.path.dirname(os.path.abspath(destination)), PREVIOUS_DIR)
+    return os.path.join(directory, f"{os.path.basename(destination)}.rejected")
+
+
+def reject(destination):
+    """
+    Record the sha256 of the installed destination as rejected, before rolling it back.
+    """
+    path = rejected_path(destination)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write(f"{file_sha256(destination)}\n")
+
+
+def rejected(destination):
+    """
+    sha256 hashes of the versions of destination that were rolled back.
+    """
+    try:
+        with open(rejected_path(destination)) as f:
+            return set(f.read().split())
+    except FileNotFoundError:
+        return set()
@@ -1,9 +1,14 @@
+import argparse
 import os
 import subprocess
 import time
 
+from staging import apply_staged_update
+
 APP_NAME = "color_changer.exe"
 UPDATER_NAME = "updater.exe"
+# Keeps the background updater from opening a console window on Windows
+NO_WINDOW = getattr(subprocess, "CREATE_NO_WINDOW", 0)
 
 
 def launch_application():
@@ -12,14 +17,37 @@ def launch_application():
     """
     try:
         print(f"Launching {APP_NAME}...")
-        subprocess.Popen([os.path.abspath(APP_NAME)], shell=True)
+        return subprocess.Popen([os.path.abspath(APP_NAME)])
     except Exception as e:
         print("Failed to launch application.")
         print(e)
         input("Press Enter to exit...")
 
 
-if __name__ == "__main__":
+def launch_with_background_update():
+    """
+    Start the installed app right away, after installing an update staged by the
+    previous run, and check for the next update in the background. The updater
+    stages what it downloads for the next launch and offers a restart.
+    """
+    try:
+        apply_staged_update(os.path.abspath(APP_NAME))
+    except OSError as e:
+        print(f"Could not install the staged update, starting the current version. Error: {e}")
+
+    app = launch_application()
+    if app is None:
+        exit(1)
+
+    updater_path = os.path.abspath(UPDATER_NAME)
+    print(f"Checking for updates in the background with {updater_path}")
+    subprocess.Popen([updater_path, "--stage", "--app-pid", str(app.pid)], creationflags=NO_WINDOW)
+
+
+def launch_after_update():
+    """
+    Run the updater, wait for it to complete, then launch the application.
+    """
     print("Starting update check...")
     try:
         # Absolute path to updater
@@ -46,3 +74,15 @@ if __name__ == "__main__":
         print(e)
         input("Press Enter to exit...")
         exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f"Launch {APP_NAME} and keep it up to date.")
+    parser.add_argument("--wait", action="store_true",
+                        help="Check for and install an update before launching, as before")
+    args = parser.parse_args()
+
+    if args.wait:
+        launch_after_update()
+    else:
+        launch_with_background_update()
@@ -1,34 +1,512 @@
 from tuf.ngclient.fetcher import FetcherInterface
-from tuf.api.exceptions import DownloadError, DownloadHTTPError
+from tuf.api.exceptions import DownloadError, DownloadHTTPError, DownloadLengthMismatchError
 
-from typing import Iterator
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import IO, Iterator
+import hashlib
+import http.client
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING as URLLIB3_ENCODINGS
+
+try:
+    import zstandard
+except ImportError:  # zstd encoded responses are then not requested
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+# Status codes worth retrying: the request may succeed once the server or a proxy recovers
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Content codings accepted for whole-file requests. urllib3 decodes gzip (and zstd in
+# recent versions); zstd is otherwise decoded here with the zstandard package.
+URLLIB3_DECODES_ZSTD = "zstd" in URLLIB3_ENCODINGS
+ACCEPT_ENCODING = "zstd, gzip" if URLLIB3_DECODES_ZSTD or zstandard is not None else "gzip"
+# Byte ranges must refer to the stored file, not to a compressed representation of it
+RANGE_HEADERS = {"Accept-Encoding": "identity"}
+# Adaptive reads are sized so that one read takes about this long at the measured throughput
+ADAPTIVE_READ_SECONDS = 0.01
+MAX_CHUNK_SIZE = 1024 * 1024
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(pool_size=DEFAULT_POOL_SIZE) -> requests.Session:
+    """
+    Return the process-wide keep-alive session for the given connection pool size,
+    so every fetch of an update cycle reuses the same TCP/TLS connections.
+    """
+    with _sessions_lock:
+        session = _sessions.get(pool_size)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[pool_size] = session
+        return session
+
+
+def iter_decoded(response, chunk_size) -> Iterator[bytes]:
+    """
+    Iterate over the body of a response with its Content-Encoding removed, so callers
+    always see the bytes of the file as stored (and signed) on the server.
+    """
+    chunks = response.iter_content(chunk_size=chunk_size)
+    if response.headers.get("Content-Encoding", "").strip().lower() != "zstd" or URLLIB3_DECODES_ZSTD:
+        yield from chunks
+        return
+    if zstandard is None:
+        raise DownloadError(f"Cannot decode the zstd response for {response.url}")
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    try:
+        for chunk in chunks:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+    except zstandard.ZstdError as e:
+        raise DownloadError(f"Cannot decode the zstd response for {response.url}: {e}")
+    if not decompressor.eof:
+        raise DownloadError(f"Truncated zstd response for {response.url}")
+
+
+def url_key(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()[:16]
+
+
+class ValidatorCache:
+    """
+    Keeps the body and validators (ETag, Last-Modified) of responses on disk, so the
+    next fetch of the same URL can be a conditional GET answered with 304 Not Modified.
+    Only responses up to max_bytes are kept; TUF verifies the replayed bytes as usual.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, url):
+        base = os.path.join(self.cache_dir, url_key(url))
+        return f"{base}.json", f"{base}.body"
+
+    def request_headers(self, url) -> dict:
+        """
+        Conditional request headers for url, empty if nothing usable is cached.
+        """
+        validators_path, body_path = self._paths(url)
+        try:
+            with open(validators_path) as f:
+                validators = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not os.path.isfile(body_path):
+            return {}
+
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        return headers
+
+    def read_body(self, url, chunk_size) -> Iterator[bytes]:
+        _, body_path = self._paths(url)
+        with open(body_path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def store(self, url, response, chunks) -> Iterator[bytes]:
+        """
+        Pass chunks through while saving them as the cached body of url. Nothing is
+        cached if the response has no validators or is larger than max_bytes.
+        """
+        validators = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        content_length = int(response.headers.get("Content-Length", 0))
+        if not any(validators.values()) or content_length > self.max_bytes:
+            yield from chunks
+            return
+
+        validators_path, body_path = self._paths(url)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                for chunk in chunks:
+                    tmp.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, body_path)
+            with open(validators_path, "w") as f:
+                json.dump(validators, f)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
 
 class CustomFetcher(FetcherInterface):
-    def __init__(self, progress_hook=None, chunk_size=4096, timeout=30):
-        self.progress_hook = progress_hook
+    def __init__(self, progress=None, chunk_size=4096, timeout=30, resume_dir=None, max_resumes=3,
+                 cache_dir=None, session=None, pool_size=DEFAULT_POOL_SIZE, retries=3, backoff_factor=0.5,
+                 max_backoff=10, segments=1, min_segment_size=1024 * 1024, adaptive=False,
+                 max_chunk_size=MAX_CHUNK_SIZE):
+        # progress.Progress that received byte counts are reported to, None for metadata
+        self.progress = progress
         self.chunk_size = chunk_size
         self.timeout = timeout
+        self.session = session if session is not None else get_session(pool_size)
+        # Bounded retries with exponential backoff for errors before the first byte arrives
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        # Directory keeping partial downloads, None disables resuming
+        self.resume_dir = resume_dir
+        self.max_resumes = max_resumes
+        # Directory keeping validators of earlier responses for conditional GETs, None disables them
+        self.validator_cache = ValidatorCache(cache_dir) if cache_dir is not None else None
+        # Number of concurrent byte ranges for large downloads, 1 disables segmented mode
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        # Read uncompressed bodies into a reused buffer, in reads between chunk_size and
+        # max_chunk_size that follow the throughput. Chunks are then memoryviews, valid
+        # until the next chunk is requested.
+        self.adaptive = adaptive
+        self.max_chunk_size = max_chunk_size
+
+    def _report_progress(self, url, downloaded_bytes):
+        if self.progress is not None:
+            self.progress.report(url, downloaded_bytes)
+
+    def _backoff(self, attempt):
+        """
+        Sleep for an exponentially growing delay with full jitter, so clients that
+        failed together do not retry in lockstep.
+        """
+        delay = min(self.max_backoff, self.backoff_factor * (2 ** attempt))
+        time.sleep(random.uniform(0, delay))
+
+    def _get(self, url, headers=None) -> requests.Response:
+        """
+        Send a streaming GET through the pooled session, retrying connection errors,
+        timeouts and transient HTTP status codes.
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.retries:
+                    return response
+                response.close()
+                logger.warning(f"HTTP error {response.status_code} for {url}, retrying")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries:
+                    raise
+                logger.warning(f"Request for {url} failed, retrying: {str(e)}")
+            self._backoff(attempt)
+            attempt += 1
 
     def _fetch(self, url: str) -> Iterator[bytes]:
+        if self.resume_dir is not None:
+            yield from self._fetch_resumable(url)
+            return
+
+        validators = self.validator_cache.request_headers(url) if self.validator_cache else {}
+        headers = {"Accept-Encoding": ACCEPT_ENCODING, **validators}
         try:
-            with requests.get(url, stream=True, timeout=self.timeout) as response:
+            with self._get(url, headers) as response:
+                if response.status_code == 304 and validators:
+                    yield from self.validator_cache.read_body(url, self.chunk_size)
+                    return
+
                 if response.status_code != 200:
                     raise DownloadHTTPError(f"HTTP error {response.status_code} for {url}",
                                             status_code=response.status_code)
 
-                content_length = int(response.headers.get("Content-Length", 0))
-                downloaded_bytes = 0
+                chunks = self._iter_response(url, response)
+                if self.validator_cache is not None:
+                    chunks = self.validator_cache.store(url, response, chunks)
+                yield from chunks
 
-                for chunk in response.iter_content(chunk_size=self.chunk_size):
-                    downloaded_bytes += len(chunk)
+        except requests.RequestException as e:
+            raise DownloadError(f"Failed to fetch {url}: {str(e)}")
 
-                    if self.progress_hook is not None:
-                        progress = int((downloaded_bytes / content_length) * 100)
-                        self.progress_hook(progress)  # Pass progress percentage
+    def _iter_response(self, url, response) -> Iterator[bytes]:
+        """
+        Yield the decoded body while reporting how many decoded bytes arrived, the
+        bytes the TargetFile length counts.
+        """
+        downloaded_bytes = 0
+        for chunk in self._iter_body(response):
+            downloaded_bytes += len(chunk)
+            self._report_progress(url, downloaded_bytes)
+            yield chunk
 
-                    yield chunk
+    def _iter_body(self, response) -> Iterator[bytes]:
+        """
+        Iterate over the body of response as stored on the server, adaptively when the
+        mode is on and the body is not encoded.
+        """
+        raw_response = getattr(response.raw, "_fp", None)
+        encoding = response.headers.get("Content-Encoding", "identity").strip().lower()
+        if not self.adaptive or encoding != "identity" or not isinstance(raw_response, http.client.HTTPResponse):
+            return iter_decoded(response, self.chunk_size)
+        return self._iter_adaptive(response, raw_response)
 
-        except requests.RequestException as e:
-            raise DownloadError(f"Failed to fetch {url}: {str(e)}")
+    def _iter_adaptive(self, response, raw_response) -> Iterator[memoryview]:
+        """
+        Read the body with readinto() from the http.client response under urllib3 into
+        one buffer, skipping the bytes objects of iter_content. The read size doubles
+        while a full read takes less than half of ADAPTIVE_READ_SECONDS and halves when
+        it takes more than twice as long, so fast links need few iterations and slow
+        ones still report progress often.
+        """
+        buffer = memoryview(bytearray(self.max_chunk_size))
+        size = min(self.chunk_size, self.max_chunk_size)
+        expected = int(response.headers.get("Content-Length", -1))
+        received = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                count = raw_response.readinto(buffer[:size])
+            except (OSError, http.client.HTTPException) as e:
+                raise requests.ConnectionError(f"Failed to read {response.url}: {e}")
+            elapsed = time.perf_counter() - started
+            if not count:
+                break
+            received += count
+            yield buffer[:count]
+
+            if count == size and elapsed < ADAPTIVE_READ_SECONDS / 2:
+                size = min(size * 2, self.max_chunk_size)
+            elif elapsed > ADAPTIVE_READ_SECONDS * 2:
+                size = max(size // 2, self.chunk_size)
+
+        if 0 <= expected != received:
+            # http.client's readinto() reports a closed connection as the end of the body
+            raise requests.exceptions.ChunkedEncodingError(
+                f"Connection closed after {received} of {expected} bytes of {response.url}")
+        # The body was read past urllib3, hand the connection back to the pool
+        response.raw.release_conn()
+
+    def partial_path(self, url: str) -> str:
+        """
+        Path of the partial download kept for url in resume mode.
+        """
+        return os.path.join(self.resume_dir, f"{url_key(url)}.part")
+
+    def fetch_into(self, url: str, path: str) -> Iterator[bytes]:
+        """
+        Like fetch(), while writing the body to path, which is kept afterwards. Bytes
+        left in path by an interrupted earlier call are resumed with a Range request,
+        so path must be unique to the content of url.
+        """
+        return self._fetch_resumable(url, path)
+
+    def _fetch_resumable(self, url: str, part_path: str = None) -> Iterator[bytes]:
+        """
+        Fetch url while keeping the received bytes in a partial file, so that a
+        dropped connection (in this call or an earlier run) continues from the
+        last good offset with a Range request instead of starting from zero.
+
+        Target URLs are prefixed with the target hash, so a partial file can
+        never be mixed with the bytes of another version. A part_path given by
+        the caller is kept once complete.
+        """
+        keep = part_path is not None
+        if not keep:
+            os.makedirs(self.resume_dir, exist_ok=True)
+            part_path = self.partial_path(url)
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        yielded = 0  # Bytes already handed to the caller in this call
+        resumes = 0
+
+        with open(part_path, "ab") as part_file:
+            while True:
+                headers = {"Range": f"bytes={offset}-", **RANGE_HEADERS} if offset else RANGE_HEADERS
+                try:
+                    with self._get(url, headers) as response:
+                        if offset and response.status_code in (200, 416):
+                            # Range ignored or partial file no longer valid: start over
+                            if yielded:
+                                raise DownloadError(f"Server cannot resume {url} at byte {offset}")
+                            part_file.truncate(0)
+                            offset = 0
+                            if response.status_code == 416:
+                                continue
+                        elif offset and response.status_code == 206:
+                            content_range = response.headers.get("Content-Range", "")
+                            if not content_range.startswith(f"bytes {offset}-"):
+                                raise DownloadError(f"Unexpected Content-Range '{content_range}' for {url}")
+                        elif response.status_code != 200:
+                            raise DownloadHTTPError(f"HTTP error {response.status_code} for {url}",
+                                                    status_code=response.status_code)
+
+                        # Replay bytes stored by an earlier run that the caller has not seen yet
+                        if yielded < offset:
+                            part_file.flush()
+                            with open(part_path, "rb") as stored:
+                                stored.seek(yielded)
+                                while yielded < offset:
+                                    chunk = stored.read(min(self.chunk_size, offset - yielded))
+                                    yielded += len(chunk)
+                                    yield chunk
+
+                        for chunk in self._iter_body(response):
+                            part_file.write(chunk)
+                            offset += len(chunk)
+                            yielded += len(chunk)
+                            self._report_progress(url, offset)
+                            yield chunk
+                    break
+
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    resumes += 1
+                    if resumes > self.max_resumes:
+                        raise DownloadError(f"Failed to fetch {url} after {self.max_resumes} resumes: {str(e)}")
+                    part_file.flush()
+                    logger.warning(f"Connection lost at byte {offset} of {url}, resuming: {str(e)}")
+
+                except requests.RequestException as e:
+                    raise DownloadError(f"Failed to fetch {url}: {str(e)}")
+
+        if not keep:
+            os.remove(part_path)
+
+    @contextmanager
+    def download_file(self, url: str, max_length: int) -> Iterator[IO]:
+        """
+        Download url into a temporary file. In segmented mode, files of at least two
+        segments are fetched as concurrent byte ranges; the caller (ngclient) verifies
+        length and hashes of the assembled file as usual.
+        """
+        if self.segments <= 1 or max_length < 2 * self.min_segment_size:
+            with super().download_file(url, max_length) as temp_file:
+                yield temp_file
+            return
+
+        with tempfile.TemporaryFile() as temp_file:
+            try:
+                self._download_segmented(url, max_length, temp_file)
+            except requests.RequestException as e:
+                raise DownloadError(f"Failed to fetch {url}: {str(e)}")
+            temp_file.seek(0)
+            yield temp_file
+
+    def _download_segmented(self, url, max_length, temp_file):
+        """
+        Split the download into byte ranges sized from max_length (the TargetFile length
+        for targets) and fetch them on a thread pool into a preallocated file. The first
+        range doubles as a probe: a server without range support answers 200 and the
+        body is streamed in a single request instead.
+        """
+        segment_size = max(self.min_segment_size, -(-max_length // self.segments))
+        write_lock = threading.Lock()
+        received = {"bytes": 0}
+        cancelled = threading.Event()
+
+        def write(offset, chunk):
+            with write_lock:
+                temp_file.seek(offset)
+                temp_file.write(chunk)
+                received["bytes"] += len(chunk)
+                self._report_progress(url, received["bytes"])
+
+        first = self._get(url, {"Range": f"bytes=0-{segment_size - 1}", **RANGE_HEADERS})
+        if first.status_code == 200:
+            with first:
+                for chunk in self._iter_response(url, first):
+                    if temp_file.tell() + len(chunk) > max_length:
+                        raise DownloadLengthMismatchError(f"Downloaded more than {max_length} bytes from {url}")
+                    temp_file.write(chunk)
+            return
+        if first.status_code != 206:
+            first.close()
+            raise DownloadHTTPError(f"HTTP error {first.status_code} for {url}", status_code=first.status_code)
+
+        total_bytes = int(first.headers.get("Content-Range", "").rpartition("/")[2] or 0)
+        if not total_bytes:
+            first.close()
+            raise DownloadError(f"Missing Content-Range in the response for {url}")
+        if total_bytes > max_length:
+            first.close()
+            raise DownloadLengthMismatchError(f"{url} is {total_bytes} bytes, more than {max_length}")
+        temp_file.truncate(total_bytes)
+
+        ranges = [(start, min(start + segment_size, total_bytes))
+                  for start in range(0, total_bytes, segment_size)]
+
+        def fetch_range(start, stop, response=None):
+            position = start
+            resumes = 0
+            while position < stop:
+                if cancelled.is_set():
+                    return
+                try:
+                    if response is None:
+                        response = self._get(url, {"Range": f"bytes={position}-{stop - 1}", **RANGE_HEADERS})
+                    with response:
+                        if response.status_code != 206 or not response.headers.get(
+                                "Content-Range", "").startswith(f"bytes {position}-"):
+                            raise DownloadError(f"Unexpected response {response.status_code} for a range of {url}")
+                        for chunk in self._iter_body(response):
+                            if cancelled.is_set():
+                                return
+                            chunk = chunk[:stop - position]
+                            write(position, chunk)
+                            position += len(chunk)
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    resumes += 1
+                    if resumes > self.max_resumes:
+                        raise DownloadError(f"Failed to fetch {url} after {self.max_resumes} resumes: {str(e)}")
+                    logger.warning(f"Connection lost at byte {position} of {url}, resuming: {str(e)}")
+                response = None
+
+        with ThreadPoolExecutor(max_workers=self.segments) as pool:
+            futures = [pool.submit(fetch_range, *ranges[0], first)]
+            futures += [pool.submit(fetch_range, start, stop) for start, stop in ranges[1:]]
+            pending = futures
+            try:
+                while pending:
+                    done, pending = wait(pending, timeout=0.1, return_when=FIRST_EXCEPTION)
+                    for future in done:
+                        future.result()
+            except BaseException:
+                cancelled.set()
+                raise
+
+
+class PerThreadFetcher(FetcherInterface):
+    """
+    Hands each download to the fetcher set for the calling thread with use(), or to
+    default. One Updater can then download several targets at once, each through a
+    fetcher of its own.
+    """
+
+    def __init__(self, default: FetcherInterface):
+        self.default = default
+        self._local = threading.local()
+
+    def use(self, fetcher: FetcherInterface):
+        self._local.fetcher = fetcher
+
+    def _current(self) -> FetcherInterface:
+        return getattr(self._local, "fetcher", self.default)
+
+    def _fetch(self, url: str) -> Iterator[bytes]:
+        return self._current()._fetch(url)
+
+    def download_file(self, url: str, max_length: int):
+        return self._current().download_file(url, max_length)
@@ -42,3 +42,28 @@ def launch_update_dialog():
 
     return user_choice  # Return the choice after the dialog is closed
 
+
+# Function to offer a restart once an update was staged in the background
+def launch_restart_dialog():
+    global user_choice
+    user_choice = None  # Reset the choice
+
+    window = tk.Tk()
+    window.title("App Update")
+    window.geometry("400x200")
+
+    status_label = tk.Label(window, text="A new version of the app is ready.\nRestart the app now to use it?",
+                            font=("Arial", 14))
+    status_label.pack(pady=20)
+
+    yes_button = tk.Button(window, text="Restart", bg="white", fg="green", font=("Arial", 12),
+                           command=lambda: [handle_update(True), window.destroy()])
+    yes_button.pack(side=tk.LEFT, padx=40, pady=20)
+
+    no_button = tk.Button(window, text="Later", bg="white", fg="red", font=("Arial", 12),
+                          command=lambda: [handle_update(False), window.destroy()])
+    no_button.pack(side=tk.RIGHT, padx=40, pady=20)
+
+    window.mainloop()
+
+    return user_choice
@@ -0,0 +1,100 @@
+"""
+Download progress, decoupled from the window that shows it.
+
+Fetchers only record how many bytes of each URL have arrived (Progress.report, a
+dict store that is safe from any thread). The thread that owns the window reads the
+count at its own pace with watch(), so a slow redraw never holds up a download. The
+total is the TargetFile length, not Content-Length, which can be missing or count
+compressed bytes.
+"""
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+UPDATE_INTERVAL = 0.1  # Seconds between window updates
+RATE_SMOOTHING = 0.3  # Weight of the latest sample in the throughput estimate
+
+
+class Progress:
+    def __init__(self, total=0):
+        self.start(total)
+
+    def start(self, total):
+        """
+        Start counting towards total bytes, forgetting earlier downloads.
+        """
+        self.total = total
+        self.rate = None  # Bytes per second, once sampled
+        self._received = {}
+        self._sampled_at = time.monotonic()
+        self._sampled_bytes = 0
+
+    def report(self, key, received_bytes):
+        """
+        Record that received_bytes of key (a URL) have arrived so far.
+        """
+        self._received[key] = received_bytes
+
+    @property
+    def received(self):
+        return sum(list(self._received.values()))
+
+    @property
+    def percent(self):
+        return min(100, self.received * 100 // self.total) if self.total else 0
+
+    @property
+    def eta(self):
+        """
+        Seconds left at the current rate, None while unknown.
+        """
+        if not self.rate or not self.total:
+            return None
+        return max(0.0, (self.total - self.received) / self.rate)
+
+    def sample(self, now=None):
+        """
+        Update the throughput estimate with the bytes received since the last sample.
+        """
+        now = time.monotonic() if now is None else now
+        received = self.received
+        if now > self._sampled_at:
+            rate = (received - self._sampled_bytes) / (now - self._sampled_at)
+            self.rate = rate if self.rate is None else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.rate
+        self._sampled_at, self._sampled_bytes = now, received
+
+    def describe(self):
+        text = f"{self.received / 2**20:.1f} of {self.total / 2**20:.1f} MiB"
+        if self.rate is not None:
+            text += f", {self.rate / 2**20:.1f} MiB/s"
+        if self.eta is not None:
+            text += f", {self.eta:.0f} s left"
+        return text
+
+
+def watch(futures, progress, show=None, interval=UPDATE_INTERVAL):
+    """
+    Wait for futures while calling show(progress) from this thread, the one that owns
+    the window, every interval and once more at the end. Raises the first exception
+    of a future.
+    """
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=interval, return_when=FIRST_EXCEPTION)
+        for future in done:
+            future.result()
+        if show is not None:
+            progress.sample()
+            show(progress)
+
+
+def run(function, progress, show=None, interval=UPDATE_INTERVAL):
+    """
+    Call function on a worker thread while showing progress from this one, and return
+    its result. Without show, function is called right here.
+    """
+    if show is None:
+        return function()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(function)
+        watch([future], progress, show, interval)
+        return future.result()
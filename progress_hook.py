@@ -12,14 +12,14 @@ class ProgressWindow:
         self.status_label.pack(pady=20)
         self.complete = False
 
-    def update(self, progress: int):
+    def update(self, progress: int, detail: str = ""):
         if progress >= 100:
             self.status_label.config(text="Update Complete!")
             self.progress_bar['value'] = 100
             self.complete = True
         else:
             self.progress_bar['value'] = progress
-            self.status_label.config(text=f"Updating... {progress}%")
+            self.status_label.config(text=f"Updating... {progress}%\n{detail}" if detail else f"Updating... {progress}%")
         self.window.update_idletasks()
 
     def close(self):
@@ -0,0 +1,86 @@
+"""
+Hashed bin delegation of the targets role.
+
+With bins enabled, the top-level targets.json lists no files. It delegates every
+target path to one of BIN_COUNT "bins-<n>" roles (a TUF succinct delegation),
+chosen by the hash of the path. A client looking up a target fetches the top-level
+targets.json and the one small bin covering that path. The metadata a client
+downloads then stays flat as the number of published files grows.
+
+A publish only bumps, re-signs and writes the bins whose file list changed, or that
+are close to expiry. Their new versions go into snapshot.json like any other role.
+"""
+import os
+from datetime import timedelta
+
+from tuf.api.metadata import Delegations, Metadata, SuccinctRoles, Targets
+
+BIN_ROLE_PREFIX = "bins"
+# Number of bins for a new repository, a power of two. 0 keeps every target in targets.json.
+BIN_COUNT = int(os.getenv("BIN_COUNT", "0"))
+# Unchanged roles are re-signed anyway once they expire within this time
+RESIGN_WITHIN = timedelta(days=2)
+
+
+def add_bin_delegation(targets, public_key, bin_count):
+    """
+    Delegate all target paths of the top-level targets to bin_count hashed bins signed
+    with public_key. The files listed so far move to the bins on the next update_bins.
+    """
+    bit_length = bin_count.bit_length() - 1
+    if bin_count < 2 or 1 << bit_length != bin_count:
+        raise ValueError(f"The bin count must be a power of two of at least 2, not {bin_count}")
+    targets.delegations = Delegations(
+        keys={}, roles=None, succinct_roles=SuccinctRoles([], 1, bit_length, BIN_ROLE_PREFIX))
+    targets.add_key(public_key)
+
+
+def bin_delegation(targets):
+    """
+    The SuccinctRoles of a hashed bin delegation in targets, or None.
+    """
+    return targets.delegations.succinct_roles if targets.delegations else None
+
+
+def load_bins(metadata_dir, snapshot, succinct_roles):
+    """
+    Load the version of every bin that snapshot lists. Bins it does not list yet are left out.
+    """
+    bins = {}
+    for name in succinct_roles.get_roles():
+        meta = snapshot.meta.get(f"{name}.json")
+        if meta is not None:
+            bins[name] = Metadata.from_file(os.path.join(metadata_dir, f"{meta.version}.{name}.json"))
+    return bins
+
+
+def all_bin_targets(bins):
+    targets = {}
+    for metadata in bins.values():
+        targets.update(metadata.signed.targets)
+    return targets
+
+
+def update_bins(bins, succinct_roles, target_files, expires, now):
+    """
+    Put every entry of target_files ({target path: TargetFile}) in its bin, creating
+    missing bins. Returns the names of the bins that changed or expire within
+    RESIGN_WITHIN; their version and expiry are bumped and they need to be signed
+    and written. The other bins keep their signed metadata as it is.
+    """
+    contents = {name: {} for name in succinct_roles.get_roles()}
+    for path, target_file in target_files.items():
+        contents[succinct_roles.get_role_for_target(path)][path] = target_file
+
+    changed = []
+    for name, targets in contents.items():
+        metadata = bins.get(name)
+        if metadata is None:
+            bins[name] = Metadata(Targets(expires=expires, targets=targets))
+            changed.append(name)
+        elif metadata.signed.targets != targets or metadata.signed.expires - now < RESIGN_WITHIN:
+            metadata.signed.targets = targets
+            metadata.signed.version += 1
+            metadata.signed.expires = expires
+            changed.append(name)
+    return changed
@@ -3,6 +3,7 @@ from __future__ import annotations
 import os
 import tempfile
 from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatch
 from pathlib import Path
 
 from securesystemslib.signer import CryptoSigner, Signer
@@ -12,16 +13,19 @@ from cryptography.hazmat.primitives.asymmetric import ec
 from tuf.api.metadata import (
     SPECIFICATION_VERSION,
     Metadata,
+    MetaFile,
     Root,
     Snapshot,
-    TargetFile,
     Targets,
     Timestamp,
 )
-from tuf.api.serialization.json import JSONSerializer
 
 # personal import
 from export_key import export_key
+from hashed_bins import BIN_COUNT, add_bin_delegation, bin_delegation, update_bins
+from make_deltas import DELTA_GLOB, add_delta_targets
+from metadata_files import metadata_serializer, write_metadata
+from target_manifest import TargetManifest
 
 
 def _in(days: float) -> datetime:
@@ -76,20 +80,25 @@ signers: dict[str, Signer] = {}
 # with their hash and length.
 roles["targets"] = Metadata(Targets(expires=_in(7)))
 
-# For the purpose of this example we use the top-level targets role to protect
-# the integrity of this very example script. The metadata entry contains the
-# hash and length of this file at the local path. In addition, it specifies the
-# 'target path', which a client uses to locate the target file relative to a
-# configured mirror base URL.
+# We use the top-level targets role to protect the integrity of every file in
+# the targets directory. Each metadata entry contains the hash and length of a
+# file at the local path. In addition, it specifies the 'target path', which a
+# client uses to locate the target file relative to a configured mirror base URL.
 #
 #      |----base artifact URL---||-------target path-------|
 # e.g. tuf-examples.org/artifacts/manual_repo/basic_repo.py
-
-local_path = Path("targets/color_changer.exe").resolve()
-target_path = f"targets/{local_path.parts[-1]}"
-
-target_file_info = TargetFile.from_file(target_path, str(local_path))
-roles["targets"].signed.targets[target_path] = target_file_info
+#
+# The hashes are kept in a manifest (see target_manifest.py), so update_repo.py
+# only hashes the files that changed since.
+manifest = TargetManifest()
+for target_path, target_file_info in manifest.scan("targets").items():
+    roles["targets"].signed.targets[target_path] = target_file_info
+
+    # Archive this first version so later releases can ship binary patches from it
+    local_path = Path("targets") / target_path.rpartition("/")[2]
+    if fnmatch(local_path.name, DELTA_GLOB):
+        add_delta_targets(roles["targets"].signed, target_path, local_path, target_file_info.hashes["sha256"])
+manifest.save()
 
 # Snapshot (consistency)
 # ----------------------
@@ -147,6 +156,27 @@ for name in ["targets", "snapshot", "timestamp", "root"]:
 # signature thresholds is to avoid having private keys all in one place.
 
 
+# Hashed bin delegation (scalability)
+# -----------------------------------
+# With BIN_COUNT set, targets delegates every target path to one of BIN_COUNT
+# "bins-<n>" roles chosen by the hash of the path, signed with a "bins" key. The
+# registered files move from targets to their bins, and snapshot lists every bin,
+# so a client only fetches the bin of the file it updates (see hashed_bins.py).
+bins: dict[str, Metadata] = {}
+if BIN_COUNT:
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    signers["bins"] = CryptoSigner(private_key=private_key)
+    export_key(private_key=private_key, name="bins")
+
+    add_bin_delegation(roles["targets"].signed, signers["bins"].public_key, BIN_COUNT)
+    update_bins(bins, bin_delegation(roles["targets"].signed), roles["targets"].signed.targets, _in(7),
+                datetime.now(timezone.utc))
+    roles["targets"].signed.targets = {}
+    for name, bin_role in bins.items():
+        bin_role.sign(signers["bins"])
+        roles["snapshot"].signed.meta[f"{name}.json"] = MetaFile(bin_role.signed.version)
+
+
 # Sign top-level metadata (in-band)
 # =================================
 # In this example we have access to all top-level signing keys, so we can use
@@ -161,17 +191,22 @@ for name in ["targets", "snapshot", "timestamp", "root"]:
 # download the target file that we have registered for this example repository.
 #
 # Also note that the TUF specification does not mandate a wireline format. In
-# this demo we use a non-compact JSON format and store all metadata in
+# this demo we use a non-compact JSON format (COMPACT_METADATA=1 for compact) and
+# store all metadata, with gzip/zstd copies for the server to send, in a
 # temporary directory at CWD for review.
-PRETTY = JSONSerializer(compact=False)
+SERIALIZER = metadata_serializer()
 TMP_DIR = tempfile.mkdtemp(dir=os.getcwd())
 
 for name in ["root", "targets", "snapshot"]:
     filename = f"{roles[name].signed.version}.{roles[name].signed.type}.json"
     path = os.path.join(TMP_DIR, filename)
-    roles[name].to_file(path, serializer=PRETTY)
+    write_metadata(roles[name], path, SERIALIZER)
+
+# Bins are delegated targets roles, named after the role like the top-level ones
+for name, bin_role in bins.items():
+    write_metadata(bin_role, os.path.join(TMP_DIR, f"{bin_role.signed.version}.{name}.json"), SERIALIZER)
 
-roles["timestamp"].to_file(os.path.join(TMP_DIR, "timestamp.json"), serializer=PRETTY)
+write_metadata(roles["timestamp"], os.path.join(TMP_DIR, "timestamp.json"), SERIALIZER)
 
 
 # Snapshot + Timestamp + Sign + Persist
@@ -185,5 +220,5 @@ for role_name in ["targets", "snapshot", "timestamp"]:
     if role_name != "timestamp":
         filename = f"{roles[role_name].signed.version}.{filename}"
 
-    roles[role_name].to_file(os.path.join(TMP_DIR, filename), serializer=PRETTY)
+    write_metadata(roles[role_name], os.path.join(TMP_DIR, filename), SERIALIZER)
 
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import re
+import shutil
+from pathlib import Path
+
+import bsdiff4
+from tuf.api.metadata import TargetFile
+
+ARCHIVE_DIR = "archive"  # Every published target version, stored as <sha256>.<filename>
+DELTA_HISTORY = 3  # Number of previous versions a patch is generated from
+DELTA_GLOB = "*.exe"  # Targets that get patches, other files are only published whole
+PATCH_NAME = re.compile(r"\.[0-9a-f]{16}\.patch$")
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def patch_name(filename, source_sha256):
+    """
+    Name of the patch turning the version with source_sha256 into the current filename.
+    Clients look it up with the hash of their local copy.
+    """
+    return f"{filename}.{source_sha256[:16]}.patch"
+
+
+def is_patch(filename):
+    return bool(PATCH_NAME.search(filename))
+
+
+def previous_versions(filename, exclude_sha256):
+    """
+    Archived versions of filename, newest first, without the one being published.
+    """
+    archived = [
+        path for path in Path(ARCHIVE_DIR).glob(f"*.{filename}")
+        if not path.name.startswith(exclude_sha256)
+    ]
+    return sorted(archived, key=lambda path: path.stat().st_mtime, reverse=True)[:DELTA_HISTORY]
+
+
+def add_delta_targets(targets, target_path, local_path, new_sha256=None):
+    """
+    Generate bsdiff patches from the last DELTA_HISTORY versions of local_path to the
+    new one, write them next to it and list them in the targets metadata so they are
+    signed like any other target. Patches for older versions of target_path are removed,
+    patches already published for this version are kept as they are.
+    """
+    local_path = Path(local_path)
+    new_sha256 = new_sha256 or file_sha256(local_path)
+    filename = local_path.name
+
+    # Drop patches that lead to an older version of this target
+    for path, target_file in list(targets.targets.items()):
+        delta = (target_file.custom or {}).get("delta", {})
+        if delta.get("target_path") == target_path and delta.get("target_sha256") != new_sha256:
+            del targets.targets[path]
+            stale_patch = local_path.parent / path.rpartition("/")[2]
+            if stale_patch.exists():
+                stale_patch.unlink()
+
+    for source in previous_versions(filename, new_sha256):
+        source_sha256 = source.name.split(".", 1)[0]
+        patch_path = local_path.parent / patch_name(filename, source_sha256)
+        patch_target_path = f"{target_path.rpartition('/')[0]}/{patch_path.name}"
+        if patch_target_path in targets.targets and patch_path.exists():
+            continue
+        bsdiff4.file_diff(str(source), str(local_path), str(patch_path))
+
+        patch_file = TargetFile.from_file(patch_target_path, str(patch_path))
+        patch_file.unrecognized_fields["custom"] = {
+            "delta": {
+                "source_sha256": source_sha256,
+                "target_path": target_path,
+                "target_sha256": new_sha256,
+            }
+        }
+        targets.targets[patch_target_path] = patch_file
+        print(f"Patch {patch_path.name}: {patch_file.length} bytes for a {local_path.stat().st_size} byte target")
+
+    # Keep the new version so the next release can diff against it
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    archived = Path(ARCHIVE_DIR) / f"{new_sha256}.{filename}"
+    if not archived.exists():
+        shutil.copy2(local_path, archived)
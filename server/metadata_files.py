@@ -0,0 +1,58 @@
+"""
+Write signed metadata for publishing.
+
+Metadata is serialized compactly when COMPACT_METADATA=1 (the default stays
+pretty-printed for review), and each file gets precompressed copies next to it,
+<name>.json.gz and, with the zstandard package installed, <name>.json.zst.
+upload.py uploads them with the rest of the metadata directory and server_host.py
+sends them to clients that accept the encoding. The signatures cover the JSON,
+so clients verify the decompressed bytes exactly as before.
+"""
+import gzip
+import os
+
+from tuf.api.serialization.json import JSONSerializer
+
+try:
+    import zstandard
+except ImportError:  # Only the gzip copies are written
+    zstandard = None
+
+COMPACT_METADATA = os.getenv("COMPACT_METADATA", "0").lower() in ("1", "true", "yes")
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+
+
+def metadata_serializer(compact=COMPACT_METADATA):
+    return JSONSerializer(compact=compact)
+
+
+def compressed_copies(data):
+    """
+    Return the precompressed copies of data keyed by file suffix. gzip gets a fixed
+    mtime so republishing the same bytes gives the same copy.
+    """
+    copies = {".gz": gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)}
+    if zstandard is not None:
+        copies[".zst"] = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return copies
+
+
+def write_metadata(metadata, path, serializer):
+    """
+    Write metadata to path along with its precompressed copies. Copies that are not
+    smaller than the file, or that this run cannot produce, are removed so no copy
+    of an earlier version is left next to it.
+    """
+    metadata.to_file(path, serializer=serializer)
+    with open(path, "rb") as f:
+        data = f.read()
+
+    copies = compressed_copies(data)
+    for suffix in (".gz", ".zst"):
+        copy_path = f"{path}{suffix}"
+        if suffix in copies and len(copies[suffix]) < len(data):
+            with open(copy_path, "wb") as f:
+                f.write(copies[suffix])
+        elif os.path.exists(copy_path):
+            os.remove(copy_path)
@@ -0,0 +1,177 @@
+"""
+Keep the published timestamp.json and snapshot.json fresh.
+
+Clients refuse metadata past its expiry. A short timestamp expiry bounds how long a
+client can be held on an old release, but only if the timestamp is re-signed well
+before it runs out. This daemon loads the snapshot and timestamp keys once, so the
+passphrase key derivation is not paid on every run, and then loops:
+
+* It polls the storage server_host.py serves from (STORAGE_BACKEND, see
+  server_storage.py) for a new timestamp.json. A release published with
+  update_repo.py and uploaded becomes the base for the next signatures.
+* A role is re-signed with a new version and expiry once less than half of its
+  lifetime is left. One published with a longer expiry is left as it is until then.
+  A new snapshot is always followed by a timestamp pointing at it.
+
+Re-signed files are written straight into the storage, snapshot before timestamp and
+with their precompressed copies, and into metadata_repo, so that the next
+update_repo.py run continues from their versions. Run it from the server directory:
+
+    python resign_daemon.py --timestamp-expiry 3600
+
+Servers notice the new files within METADATA_CACHE_TTL (see server_common.py).
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from tuf.api.metadata import Metadata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metadata_files import write_metadata  # noqa: E402
+from server_storage import open_storage, put_file  # noqa: E402
+from update_repo import METADATA_DIR, SERIALIZER, load_signers  # noqa: E402
+
+TIMESTAMP_EXPIRY = int(os.getenv("TIMESTAMP_EXPIRY", 3600))  # Seconds
+SNAPSHOT_EXPIRY = int(os.getenv("SNAPSHOT_EXPIRY", 7 * 24 * 3600))  # Seconds
+POLL_INTERVAL = 0.5  # Seconds between checks of the storage
+
+logger = logging.getLogger("resign_daemon.py")
+
+
+def needs_signing(metadata, lifetime, now):
+    return metadata.signed.expires - now < lifetime / 2
+
+
+class Resigner:
+    """
+    Re-signs the published snapshot and timestamp with signers loaded once.
+    """
+
+    def __init__(self, storage, signers, timestamp_expiry, snapshot_expiry):
+        self.storage = storage
+        self.signers = signers
+        self.timestamp_expiry = timestamp_expiry
+        self.snapshot_expiry = snapshot_expiry
+        self.timestamp = None
+        self.snapshot = None
+        self.published_id = None  # Id of the timestamp.json the storage held when last checked
+        self.resign_timestamp = False
+
+    def _load(self, filename):
+        stored = self.storage.find(f"metadata/{filename}")
+        if stored is None:
+            raise FileNotFoundError(f"metadata/{filename} is not in the storage")
+        return Metadata.from_bytes(stored.read())
+
+    def refresh(self):
+        """
+        Pick up a timestamp.json published since the last check, with its snapshot.
+        """
+        current_id = self.storage.current_id("metadata/timestamp.json")
+        if current_id is None or current_id == self.published_id:
+            return
+        timestamp = self._load("timestamp.json")
+        snapshot = self._load(f"{timestamp.signed.snapshot_meta.version}.snapshot.json")
+
+        # A release built before our last signature reused its version, clients would ignore it
+        previous_version = self.timestamp.signed.version if self.timestamp else 0
+        self.resign_timestamp = timestamp.signed.version <= previous_version
+        if self.resign_timestamp:
+            timestamp.signed.version = previous_version
+        self.timestamp, self.snapshot, self.published_id = timestamp, snapshot, current_id
+        logger.info(f"Picked up timestamp version {timestamp.signed.version} "
+                    f"(snapshot version {snapshot.signed.version})")
+
+    def publish(self, metadata, filename):
+        """
+        Write metadata to METADATA_DIR and the storage, returning the stored file id.
+        """
+        path = Path(METADATA_DIR) / filename
+        write_metadata(metadata, str(path), SERIALIZER)
+        file_id = None
+        for suffix in ("", ".gz", ".zst"):
+            stored_name = f"metadata/{filename}{suffix}"
+            if os.path.exists(f"{path}{suffix}"):
+                with open(f"{path}{suffix}", "rb") as f:
+                    stored_id = put_file(self.storage, stored_name, f.read())
+                file_id = file_id or stored_id
+            else:
+                # write_metadata dropped the copy, the stored one belongs to an older version
+                stale = self.storage.find(stored_name)
+                if stale is not None:
+                    stale.close()
+                    self.storage.delete(stale)
+        return file_id
+
+    def tick(self, now=None):
+        """
+        Re-sign and publish what needs it. Returns the names of the published roles.
+        """
+        self.refresh()
+        if self.timestamp is None:
+            logger.warning("Nothing published yet, waiting for timestamp.json")
+            return []
+        now = now or datetime.now(timezone.utc)
+        started = time.perf_counter()
+        published = []
+
+        if needs_signing(self.snapshot, self.snapshot_expiry, now):
+            snapshot = self.snapshot.signed
+            snapshot.version += 1
+            snapshot.expires = now.replace(microsecond=0) + self.snapshot_expiry
+            self.snapshot.sign(self.signers["snapshot"])
+            self.publish(self.snapshot, f"{snapshot.version}.snapshot.json")
+            published.append("snapshot")
+
+        if published or self.resign_timestamp or needs_signing(self.timestamp, self.timestamp_expiry, now):
+            timestamp = self.timestamp.signed
+            timestamp.version += 1
+            timestamp.expires = now.replace(microsecond=0) + self.timestamp_expiry
+            timestamp.snapshot_meta.version = self.snapshot.signed.version
+            self.timestamp.sign(self.signers["timestamp"])
+            self.published_id = self.publish(self.timestamp, "timestamp.json")
+            self.resign_timestamp = False
+            published.append("timestamp")
+
+        if published:
+            logger.info(f"Published {' and '.join(published)} version {self.timestamp.signed.version} "
+                        f"in {(time.perf_counter() - started) * 1000:.0f} ms, "
+                        f"expires {self.timestamp.signed.expires.isoformat()}")
+        return published
+
+    def run(self, interval=POLL_INTERVAL):
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                # The storage may be briefly unreachable, the next tick tries again
+                logger.exception(f"Re-signing failed. Error: {str(e)}")
+            time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-sign and publish timestamp and snapshot metadata on a schedule.")
+    parser.add_argument("--timestamp-expiry", type=int, default=TIMESTAMP_EXPIRY,
+                        help=f"Lifetime of a timestamp in seconds (default: {TIMESTAMP_EXPIRY})")
+    parser.add_argument("--snapshot-expiry", type=int, default=SNAPSHOT_EXPIRY,
+                        help=f"Lifetime of a snapshot in seconds (default: {SNAPSHOT_EXPIRY})")
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL,
+                        help=f"Seconds between checks (default: {POLL_INTERVAL})")
+    parser.add_argument("--once", action="store_true", help="Check and re-sign once, then exit")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    storage = open_storage()
+    storage.setup()
+    resigner = Resigner(storage, load_signers(["snapshot", "timestamp"]),
+                        timedelta(seconds=args.timestamp_expiry), timedelta(seconds=args.snapshot_expiry))
+    if args.once:
+        resigner.tick()
+    else:
+        resigner.run(args.interval)
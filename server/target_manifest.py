@@ -0,0 +1,119 @@
+"""
+Lengths and hashes of the files in a targets directory, for publishing.
+
+The manifest file remembers the result for every file it has hashed, keyed by its
+path and checked against its (size, mtime, inode). A publish therefore only reads
+the files that are new or changed since the last one. Those are hashed on a thread
+pool: hashlib releases the GIL while it hashes, so the threads use every core
+without re-importing the publishing scripts in child processes as a process pool
+would on Windows.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tuf.api.metadata import TargetFile
+
+from make_deltas import is_patch
+
+MANIFEST_FILE = "target_manifest.json"  # Kept next to the metadata_repo and keys directories
+HASH_ALGORITHMS = ["sha256"]  # Same as TargetFile.from_file
+BLOCK_SIZE = 1024 * 1024
+# Files modified this recently are hashed but not remembered: a change within the same
+# mtime tick would otherwise go unnoticed on the next publish
+RACY_SECONDS = 2
+
+
+def hash_file(path):
+    """
+    Return (length, hashes) of the file at path, read once for all HASH_ALGORITHMS.
+    """
+    digests = {algorithm: hashlib.new(algorithm) for algorithm in HASH_ALGORITHMS}
+    length = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            length += len(block)
+            for digest in digests.values():
+                digest.update(block)
+    return length, {algorithm: digest.hexdigest() for algorithm, digest in digests.items()}
+
+
+def stat_key(stat):
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+class TargetManifest:
+    """
+    Persistent cache of target file hashes. Use scan() to get the TargetFiles of a
+    directory and save() afterwards to keep the hashes for the next publish.
+    """
+
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def scan(self, directory, workers=None):
+        """
+        Return {target path: TargetFile} for the files in directory, with target paths
+        of the form targets/<filename> as the server stores them. Targets are flat:
+        subdirectories are not published. Delta patches are skipped,
+        make_deltas.add_delta_targets lists them.
+        """
+        files = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and not is_patch(entry.name):
+                    files[f"targets/{entry.name}"] = (os.path.abspath(entry.path), entry.stat())
+
+        target_files = {}
+        to_hash = []
+        for target_path, (local_path, stat) in files.items():
+            cached = self.entries.get(local_path)
+            if cached is not None and cached["key"] == stat_key(stat):
+                target_files[target_path] = TargetFile(cached["length"], cached["hashes"], target_path)
+            else:
+                to_hash.append((target_path, local_path, stat))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(hash_file, [local_path for _, local_path, _ in to_hash])
+            for (target_path, local_path, stat), (length, hashes) in zip(to_hash, results):
+                target_files[target_path] = TargetFile(length, hashes, target_path)
+                unchanged = stat_key(os.stat(local_path)) == stat_key(stat)
+                if unchanged and time.time_ns() - stat.st_mtime_ns > RACY_SECONDS * 10 ** 9:
+                    self.entries[local_path] = {"key": stat_key(stat), "length": length, "hashes": hashes}
+                else:
+                    self.entries.pop(local_path, None)
+
+        # Forget files that are gone from the scanned directory
+        scanned = {local_path for local_path, _ in files.values()}
+        directory = os.path.abspath(directory)
+        for local_path in list(self.entries):
+            if os.path.dirname(local_path) == directory and local_path not in scanned:
+                del self.entries[local_path]
+
+        hashed_bytes = sum(stat.st_size for _, _, stat in to_hash)
+        print(f"Hashed {len(to_hash)} of {len(files)} targets ({hashed_bytes / 2**20:.1f} MiB) "
+              f"in {time.perf_counter() - started:.2f} s")
+        return target_files
+
+    def save(self):
+        """
+        Write the manifest atomically, so an interrupted publish leaves the previous one.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -1,13 +1,21 @@
+import argparse
 import os
 from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatch
 from pathlib import Path
 
-from tuf.api.metadata import Metadata
-from tuf.api.metadata import TargetFile
-from tuf.api.serialization.json import JSONSerializer
+from cryptography.hazmat.primitives.asymmetric import ec
+from tuf.api.metadata import Metadata, MetaFile, Targets
 from securesystemslib.signer import CryptoSigner
 
+from export_key import export_key
+from hashed_bins import (
+    BIN_COUNT, RESIGN_WITHIN, add_bin_delegation, all_bin_targets, bin_delegation, load_bins, update_bins,
+)
 from import_key import import_key
+from make_deltas import DELTA_GLOB, add_delta_targets
+from metadata_files import metadata_serializer, write_metadata
+from target_manifest import TargetManifest
 
 
 # Helper function to calculate expiration date
@@ -19,77 +27,170 @@ def _in(days: float) -> datetime:
 ROLES = ["root", "targets", "snapshot", "timestamp"]
 METADATA_DIR = "metadata_repo"  # Directory where the metadata resides
 PRIVATE_KEYS_DIR = "keys"  # Directory containing private key PEM files
-PRETTY = JSONSerializer(compact=False)
-last_version = 1
-ROOT_LAST_VERSION = 1
-
-# Step 1: Load existing metadata
-metadata = {}
-for role in ROLES:
-    if role == "root":
-        metadata_file = Path(METADATA_DIR) / f"{ROOT_LAST_VERSION}.{role}.json"
-        with metadata_file.open("r") as f:
-            metadata[role] = Metadata.from_file(str(metadata_file))
-    elif role != "timestamp":
-        metadata_file = Path(METADATA_DIR) / f"{last_version}.{role}.json"
-        with metadata_file.open("r") as f:
-            metadata[role] = Metadata.from_file(str(metadata_file))
+TARGETS_DIR = "targets"  # Every file in it is published as a target
+SERIALIZER = metadata_serializer()  # Compact with COMPACT_METADATA=1
+
+
+def latest_version(role: str) -> int:
+    """
+    Highest N of the N.<role>.json files in METADATA_DIR.
+    """
+    versions = [
+        int(path.name.split(".", 1)[0]) for path in Path(METADATA_DIR).glob(f"*.{role}.json")
+        if path.name.split(".", 1)[0].isdigit()
+    ]
+    if not versions:
+        raise FileNotFoundError(f"No {role} metadata in {METADATA_DIR}, run init_repo.py first")
+    return max(versions)
+
+
+def load_metadata() -> dict:
+    """
+    Step 1: Load the latest version of every role.
+    """
+    metadata = {}
+    for role in ROLES:
+        if role == "timestamp":
+            metadata_file = Path(METADATA_DIR) / f"{role}.json"
+        else:
+            metadata_file = Path(METADATA_DIR) / f"{latest_version(role)}.{role}.json"
+        metadata[role] = Metadata.from_file(str(metadata_file))
+    return metadata
+
+
+def load_signers(roles: list) -> dict:
+    """
+    Step 2: Import private keys for signing.
+    """
+    signers = {}
+    for role in roles:
+        private_key_path = Path(PRIVATE_KEYS_DIR) / f"{role}_private_key.pem"
+        private_key = import_key(file_path=private_key_path)
+
+        signers[role] = CryptoSigner(private_key=private_key)
+    return signers
+
+
+def update_targets(targets, target_files: dict, targets_dir: str, delta_glob: str = DELTA_GLOB):
+    """
+    Make the targets metadata list exactly the files of targets_dir, plus binary
+    patches for the files matching delta_glob.
+    """
+    # Drop targets that left the directory, together with the patches leading to them
+    for path, target_file in list(targets.targets.items()):
+        delta = (target_file.custom or {}).get("delta")
+        if (delta["target_path"] if delta else path) not in target_files:
+            del targets.targets[path]
+            if delta:
+                stale_patch = Path(targets_dir) / path.rpartition("/")[2]
+                if stale_patch.exists():
+                    stale_patch.unlink()
+            print(f"Removed {path}")
+
+    for target_path, target_file in target_files.items():
+        targets.targets[target_path] = target_file
+
+        # Publish binary patches from the previous versions as signed targets of their own
+        local_path = Path(targets_dir) / target_path.rpartition("/")[2]
+        if fnmatch(local_path.name, delta_glob):
+            add_delta_targets(targets, target_path, local_path, target_file.hashes["sha256"])
+
+
+def publish(targets_dir: str = TARGETS_DIR, workers: int = None, delta_glob: str = DELTA_GLOB,
+            bin_count: int = BIN_COUNT):
+    """
+    Publish the files in targets_dir as a new release: hash new and changed files,
+    update, sign and save the targets roles that changed, snapshot and timestamp.
+
+    With a hashed bin delegation (see hashed_bins.py) the files are listed in the
+    bins and only the bins that changed are re-signed. bin_count moves a repository
+    without bins to that many bins.
+    """
+    metadata = load_metadata()
+    targets = metadata["targets"].signed
+    succinct_roles = bin_delegation(targets)
+    if succinct_roles is not None and bin_count and succinct_roles.number_of_bins != bin_count:
+        raise ValueError(f"The repository already uses {succinct_roles.number_of_bins} bins")
+    if succinct_roles is None and bin_count and not (Path(PRIVATE_KEYS_DIR) / "bins_private_key.pem").exists():
+        export_key(private_key=ec.generate_private_key(ec.SECP256R1()), name="bins")
+    uses_bins = succinct_roles is not None or bool(bin_count)
+    signers = load_signers(ROLES + (["bins"] if uses_bins else []))
+
+    # Step 3: Update the metadata
+    manifest = TargetManifest()
+    target_files = manifest.scan(targets_dir, workers)
+    now = datetime.now(timezone.utc)
+    changed_roles = ["snapshot", "timestamp"]
+    changed_bins = []
+    bins = {}
+
+    if not uses_bins:
+        # Update Targets
+        update_targets(targets, target_files, targets_dir, delta_glob)
+        changed_roles.insert(0, "targets")
     else:
-        metadata_file = Path(METADATA_DIR) / f"{role}.json"
-        with metadata_file.open("r") as f:
-            metadata[role] = Metadata.from_file(str(metadata_file))
-
-# Step 2: Import private keys for signing
-signers = {}
-for role in ROLES:
-    private_key_path = Path(PRIVATE_KEYS_DIR) / f"{role}_private_key.pem"
-    private_key = import_key(file_path=private_key_path)
-
-    signers[role] = CryptoSigner(private_key=private_key)
-
-# Step 3: Update the metadata
-# Update Targets
-metadata["targets"].signed.version += 1
-metadata["targets"].signed.expires = _in(7)  # Set expiration 7 days from now
-
-# Add or update target files (optional)
-# adding a new file
-new_target_path = Path("targets/color_changer.exe").resolve()
-# new_target_relative_path = f"{new_target_path.parts[-2]}/{new_target_path.parts[-1]}"  # Relative path to target
-new_target_relative_path = f"targets/{new_target_path.parts[-1]}"
-metadata["targets"].signed.targets[new_target_relative_path] = TargetFile.from_file(new_target_relative_path, str(new_target_path))
-
-# Update Snapshot
-metadata["snapshot"].signed.version += 1
-metadata["snapshot"].signed.expires = _in(7)  # Set expiration 7 days from now
-metadata["snapshot"].signed.meta["targets.json"].version = metadata["targets"].signed.version
-
-# Update Timestamp
-metadata["timestamp"].signed.version += 1
-metadata["timestamp"].signed.expires = _in(7)  # Set expiration 1 day from now
-metadata["timestamp"].signed.snapshot_meta.version = metadata["snapshot"].signed.version
-
-# Step 4: Sign updated metadata
-for role in ["targets", "snapshot", "timestamp"]:
-    metadata[role].sign(signers[role])
-
-# Step 5: Save updated metadata to disk
-# Save updated metadata to disk with consistent snapshot naming
-for role in ["targets", "snapshot"]:
-    # Use the version number from the metadata
-    version = metadata[role].signed.version
-    file_name = f"{version}.{role}.json"
-    output_path = Path(METADATA_DIR) / file_name
-    metadata[role].to_file(str(output_path), serializer=PRETTY)
-
-# Save timestamp.json (always without version prefix)
-metadata["timestamp"].to_file(f"{Path(METADATA_DIR)}/timestamp.json", serializer=PRETTY)
-
-
-print("Repository metadata updated successfully.")
-
-
-def update_root(metadata, tmp_dir):
+        delegation_added = succinct_roles is None
+        if delegation_added:
+            add_bin_delegation(targets, signers["bins"].public_key, bin_count)
+            succinct_roles = bin_delegation(targets)
+        else:
+            bins = load_bins(METADATA_DIR, metadata["snapshot"].signed, succinct_roles)
+
+        # Update the full target list, then hand each file to its bin
+        listed = Targets(targets={**targets.targets, **all_bin_targets(bins)})
+        update_targets(listed, target_files, targets_dir, delta_glob)
+        changed_bins = update_bins(bins, succinct_roles, listed.targets, _in(7), now)
+        print(f"Re-signing {len(changed_bins)} of {len(bins)} bins")
+
+        # The top-level targets only delegates, it changes when the delegation is added or expires soon
+        if delegation_added or targets.expires - now < RESIGN_WITHIN:
+            targets.targets = {}
+            changed_roles.insert(0, "targets")
+
+    # Update Targets
+    if "targets" in changed_roles:
+        metadata["targets"].signed.version += 1
+        metadata["targets"].signed.expires = _in(7)  # Set expiration 7 days from now
+
+    # Update Snapshot
+    metadata["snapshot"].signed.version += 1
+    metadata["snapshot"].signed.expires = _in(7)  # Set expiration 7 days from now
+    metadata["snapshot"].signed.meta["targets.json"].version = metadata["targets"].signed.version
+    for name in changed_bins:
+        metadata["snapshot"].signed.meta[f"{name}.json"] = MetaFile(bins[name].signed.version)
+
+    # Update Timestamp
+    metadata["timestamp"].signed.version += 1
+    metadata["timestamp"].signed.expires = _in(7)  # Set expiration 1 day from now
+    metadata["timestamp"].signed.snapshot_meta.version = metadata["snapshot"].signed.version
+
+    # Step 4: Sign updated metadata
+    for role in changed_roles:
+        metadata[role].sign(signers[role])
+    for name in changed_bins:
+        bins[name].sign(signers["bins"])
+
+    # Step 5: Save updated metadata to disk
+    # Save updated metadata to disk with consistent snapshot naming
+    versioned = [(role, metadata[role]) for role in changed_roles if role != "timestamp"]
+    versioned += [(name, bins[name]) for name in changed_bins]
+    for role, role_metadata in versioned:
+        # Use the version number from the metadata
+        version = role_metadata.signed.version
+        file_name = f"{version}.{role}.json"
+        output_path = Path(METADATA_DIR) / file_name
+        write_metadata(role_metadata, str(output_path), SERIALIZER)
+
+    # Save timestamp.json (always without version prefix)
+    write_metadata(metadata["timestamp"], f"{Path(METADATA_DIR)}/timestamp.json", SERIALIZER)
+
+    # Keep the hashes only once the release that uses them is written
+    manifest.save()
+
+    print("Repository metadata updated successfully.")
+
+
+def update_root(metadata, signers, tmp_dir):
     new_root_signer = CryptoSigner.generate_ecdsa()
 
     metadata["root"].signed.revoke_key(signers["root"].public_key.keyid, "root")
@@ -100,9 +201,21 @@ def update_root(metadata, tmp_dir):
     for signer in [signers["root"], new_root_signer]:
         metadata["root"].sign(signer, append=True)
 
-    metadata["root"].to_file(
+    write_metadata(
+        metadata["root"],
         os.path.join(tmp_dir, f"{metadata['root'].signed.version}.root.json"),
-        serializer=PRETTY,
+        SERIALIZER,
     )
 # tmp_dir = Path(METADATA_DIR)
-# update_root(metadata,tmp_dir )
\ No newline at end of file
+# update_root(metadata, signers, tmp_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish the files of the targets directory as a new release.")
+    parser.add_argument("--targets-dir", default=TARGETS_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="Hashing threads (default: based on the CPU count)")
+    parser.add_argument("--delta-glob", default=DELTA_GLOB, help=f"Targets that get binary patches (default: {DELTA_GLOB})")
+    parser.add_argument("--bins", type=int, default=BIN_COUNT,
+                        help="Move the targets into this many hashed bins (a power of two) if not done yet")
+    args = parser.parse_args()
+    publish(args.targets_dir, args.workers, args.delta_glob, args.bins)
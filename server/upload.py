@@ -1,61 +1,253 @@
-import re
-import requests
+"""
+Upload a release to the server.
+
+Targets are sent first, several at a time over one pooled session. Each file is
+hashed and probed (HEAD /upload/targets/<sha256>): content the server already
+stores is linked by name instead of sent again, the rest is streamed from disk
+with POST /upload. Each request, probes included, is retried on its own if the
+connection drops or the server answers 5xx. The metadata of the release then goes
+to /publish in one request, which makes it visible atomically, timestamp.json
+last. Versioned metadata the server already has is skipped.
+
+The release metadata is what metadata_repo/timestamp.json points to: its snapshot,
+the targets and bins versions that snapshot lists, every root version and the
+precompressed copies of all of them. Run it from the server directory:
+
+    python upload.py --url http://localhost:8001 --workers 8
+"""
+import argparse
+import hashlib
+import json
 import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import requests
+from requests.adapters import HTTPAdapter
+
+SERVER_URL = "https://tuf-server-y43f.onrender.com"
+METADATA_DIR = "metadata_repo"
+TARGETS_DIR = "targets"
+WORKERS = 4  # Files uploaded at the same time
+RETRIES = 3  # Extra attempts per file after a connection error or 5xx answer
+RETRY_BACKOFF = 1.0  # Seconds before the first retry, doubled for each further one
+TIMEOUT = (10, 300)  # Connect and read timeouts in seconds
+VERSIONED_FILE = re.compile(r"^(\d+)\.")
+COPY_SUFFIXES = (".gz", ".zst")
+BLOCK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    """
+    SHA-256 of the file, read here rather than imported from make_deltas so uploading
+    only needs requests, not bsdiff4.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class MultipartStream:
+    """
+    A multipart/form-data body of form fields and (field name, file path) parts that
+    is read from the files while it is sent. Its length is known up front, so requests
+    sends it with a Content-Length instead of holding the files in memory.
+    """
+
+    def __init__(self, parts, fields=None):
+        self.boundary = uuid.uuid4().hex
+        self._segments = []
+        for name, values in (fields or {}).items():
+            for value in values if isinstance(values, list) else [values]:
+                self._segments.append((f"--{self.boundary}\r\n"
+                                       f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                                       f"{value}\r\n").encode())
+        for name, file_path in parts:
+            header = (f"--{self.boundary}\r\n"
+                      f'Content-Disposition: form-data; name="{name}"; filename="{os.path.basename(file_path)}"\r\n'
+                      f"Content-Type: application/octet-stream\r\n\r\n")
+            self._segments += [header.encode(), file_path, b"\r\n"]
+        self._segments.append(f"--{self.boundary}--\r\n".encode())
+        self._length = sum(len(s) if isinstance(s, bytes) else os.path.getsize(s) for s in self._segments)
+        self._file = None
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        chunks = []
+        while self._segments and size != 0:
+            segment = self._segments[0]
+            if isinstance(segment, bytes):
+                chunk = segment if size < 0 else segment[:size]
+                if len(chunk) == len(segment):
+                    self._segments.pop(0)
+                else:
+                    self._segments[0] = segment[len(chunk):]
+            else:
+                if self._file is None:
+                    self._file = open(segment, "rb")
+                chunk = self._file.read(size)
+                if not chunk or size < 0:
+                    self._file.close()
+                    self._file = None
+                    self._segments.pop(0)
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def release_metadata(metadata_dir):
+    """
+    Names of the metadata files of the release metadata_dir/timestamp.json points to,
+    versioned files first. A file's precompressed copies are listed right after it.
+    """
+    with open(Path(metadata_dir) / "timestamp.json", "rb") as f:
+        snapshot_version = json.load(f)["signed"]["meta"]["snapshot.json"]["version"]
+    snapshot_name = f"{snapshot_version}.snapshot.json"
+    with open(Path(metadata_dir) / snapshot_name, "rb") as f:
+        snapshot_meta = json.load(f)["signed"]["meta"]
+
+    names = sorted(
+        (path.name for path in Path(metadata_dir).glob("*.root.json") if VERSIONED_FILE.match(path.name)),
+        key=lambda name: int(VERSIONED_FILE.match(name).group(1)),
+    )
+    names += [f"{meta['version']}.{role}" for role, meta in snapshot_meta.items()]
+    names += [snapshot_name, "timestamp.json"]
+    return [name_with_copy for name in names for name_with_copy in [name] + [
+        f"{name}{suffix}" for suffix in COPY_SUFFIXES if (Path(metadata_dir) / f"{name}{suffix}").exists()]]
+
+
+class Uploader:
+    """
+    Sends files to the server over one session shared by the worker threads, and
+    counts what it sent.
+    """
+
+    def __init__(self, url=SERVER_URL, workers=WORKERS, retries=RETRIES):
+        self.url = url.rstrip("/")
+        self.workers = workers
+        self.retries = retries
+        self.session = requests.Session()
+        # One kept-alive connection per worker
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Counted by all worker threads
+        self._lock = threading.Lock()
+        self.sent_bytes = 0
+        self.retried = 0
+
+    def _send(self, method, path, parts=None, fields=None):
+        """
+        Send a request, with a streamed multipart body of parts and fields unless parts
+        is None, retrying it from the start on connection errors and 5xx answers.
+        Returns the first response below 500.
+        """
+        for attempt in range(self.retries + 1):
+            body = MultipartStream(parts, fields) if parts is not None else None
+            try:
+                headers = {"Content-Type": body.content_type} if body is not None else None
+                response = self.session.request(method, f"{self.url}{path}", data=body, timeout=TIMEOUT,
+                                                headers=headers)
+                if response.status_code < 500:
+                    if body is not None:
+                        with self._lock:
+                            self.sent_bytes += len(body)
+                    return response
+                error = requests.HTTPError(f"{response.status_code} from {path}: {response.text[:200]}")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                if body is not None:
+                    body.close()
+            if attempt < self.retries:
+                with self._lock:
+                    self.retried += 1
+                delay = RETRY_BACKOFF * 2 ** attempt
+                print(f"Retrying {path} in {delay:.0f} s after: {error}")
+                time.sleep(delay)
+        raise error
+
+    def _post(self, path, parts, fields=None):
+        """
+        POST a streamed multipart body (see _send). Errors other than connection errors
+        and 5xx answers are raised at once.
+        """
+        response = self._send("POST", path, parts, fields)
+        response.raise_for_status()
+        return response.json()
+
+    def _exists(self, path):
+        response = self._send("HEAD", path)
+        if response.status_code not in (200, 404):
+            response.raise_for_status()
+        return response.status_code == 200
+
+    def upload_target(self, file_path):
+        """
+        Send a target unless the server already has its content. Returns the
+        <sha256>.<filename> link for content the server has, otherwise None.
+        """
+        sha256_hash = file_sha256(file_path)
+        if self._exists(f"/upload/targets/{sha256_hash}"):
+            return f"{sha256_hash}.{os.path.basename(file_path)}"
+        self._post("/upload", [("file", file_path)], {"category": "targets"})
+        print(f"Uploaded {os.path.basename(file_path)}")
+        return None
+
+    def missing_metadata(self, metadata_dir, names):
+        """
+        Names the server does not have yet. Versioned files never change, so one it
+        has is skipped along with its copies; timestamp.json is always sent.
+        """
+        def stored(name):
+            return bool(VERSIONED_FILE.match(name)) and self._exists(f"/metadata/{name}")
+
+        base_names = [name for name in names if not name.endswith(COPY_SUFFIXES)]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            skip = {name for name, exists in zip(base_names, pool.map(stored, base_names)) if exists}
+        return [name for name in names if re.sub(r"\.(gz|zst)$", "", name) not in skip]
+
+    def upload_release(self, metadata_dir=METADATA_DIR, targets_dir=TARGETS_DIR):
+        started = time.perf_counter()
+        target_paths = sorted(str(path) for path in Path(targets_dir).iterdir() if path.is_file())
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            links = [link for link in pool.map(self.upload_target, target_paths) if link]
+
+        names = self.missing_metadata(metadata_dir, release_metadata(metadata_dir))
+        result = self._post("/publish", [("metadata", str(Path(metadata_dir) / name)) for name in names],
+                            {"link": links} if links else None)
+
+        elapsed = time.perf_counter() - started
+        print(f"Published {len(result['metadata'])} metadata files and {len(target_paths)} targets "
+              f"({len(links)} already on the server, {self.retried} retries): "
+              f"sent {self.sent_bytes / 2**20:.1f} MiB in {elapsed:.1f} s, "
+              f"{self.sent_bytes / 2**20 / elapsed:.1f} MiB/s")
+        return result
+
 
-def check_folder(directory, category):
-    category_list = ["targets", "metadata"]
-    file_list = []
-
-    if category not in category_list:
-        print("Invalid category. Use 'metadata' or 'targets'.")
-        return
-
-    if category == "metadata":
-        directory_path = Path(directory)
-        for filename in os.listdir(directory_path):
-            f = os.path.join(directory_path, filename)
-            if os.path.isfile(f):
-                file_list.append(f)
-        return file_list
-
-    if category == "targets":
-        directory_path = Path(directory)
-        for filename in os.listdir(directory_path):
-            f = os.path.join(directory_path, filename)
-            file_list.append(f)
-        return file_list
-
-
-def upload( directory, category, version_no):
-    file_list = check_folder(directory, category)
-    url = "https://tuf-server-y43f.onrender.com/upload"
-    version_number = version_no
-    pattern = r"\\(\d+)\."
-
-    for file_path in file_list:
-
-
-        # Extract integer from the file name using regex
-        match = re.search(pattern, file_path)
-        if match:
-            extracted_integer = int(match.group(1))
-
-            if extracted_integer == version_number:
-                with open(file_path, "rb") as file:
-                    file = {"file": file}
-                    payload = {"category":category }
-                    res = requests.post(url=url, files=file, data=payload)
-                    print(res.text)
-        else:
-            with open(file_path, "rb") as file:
-                file = {"file": file}
-                payload = {"category":category }
-                res = requests.post(url=url, files=file, data=payload)
-                print(res.text)
-
-directory = "targets"
-category = "targets"
-version_no = 2
-upload(directory, category, version_no)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload the release in the metadata and targets directories.")
+    parser.add_argument("--url", default=SERVER_URL, help=f"Server URL (default: {SERVER_URL})")
+    parser.add_argument("--metadata-dir", default=METADATA_DIR)
+    parser.add_argument("--targets-dir", default=TARGETS_DIR)
+    parser.add_argument("--workers", type=int, default=WORKERS, help=f"Parallel uploads (default: {WORKERS})")
+    parser.add_argument("--retries", type=int, default=RETRIES, help=f"Retries per file (default: {RETRIES})")
+    args = parser.parse_args()
+    Uploader(args.url, args.workers, args.retries).upload_release(args.metadata_dir, args.targets_dir)
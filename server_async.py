@@ -0,0 +1,332 @@
+"""
+Asyncio serving mode for the TUF repository.
+
+Exposes the same routes as server_host.py on an ASGI server, with streaming request
+and response bodies, so a slow client holds a coroutine instead of a worker thread
+for the whole transfer:
+
+    uvicorn server_async:app --host 0.0.0.0 --port 8001 --workers 2
+
+It serves the storage selected by STORAGE_BACKEND (see server_storage.py), the same
+one server_host.py and the resign daemon use. The backends block, so every storage
+call runs on a worker thread with asyncio.to_thread, and file bodies are read through
+quart.utils.run_sync_iterable; the event loop itself only waits on sockets.
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+from quart import Quart, Response, abort, g, jsonify, request
+from quart.utils import run_sync_iterable
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+from server_common import (
+    METADATA_CACHE_BYTES, METADATA_CACHE_TTL, SHA256_HEX, MetadataCache, check_release, metadata_base_name,
+    plan_file_response, release_summary,
+)
+from server_metrics import CONTENT_TYPE, METRICS_ENABLED, cache_gauges, observe_request, render
+from server_storage import finalize_metadata, load_metadata, open_storage, publish_files, store_target
+
+load_dotenv()
+app = Quart(__name__)
+# Largest accepted request body in bytes, Quart answers 413 above it
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_UPLOAD_SIZE", 1024 * 1024 * 1024))
+
+# Storage setup
+storage = open_storage()
+
+
+# Configure logging
+BASE_DIR = os.path.dirname(os.path.abspath(sys.argv[0]))  # Directory of the executable
+LOG_FILE = os.path.join(BASE_DIR, "log", "server_async.log")
+os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler(LOG_FILE),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger('server_async.py')
+
+
+# Index setup
+@app.before_serving
+async def setup_storage():
+    """
+    Create the indexes or directories the request paths rely on, see
+    server_storage.GridFSStorage.setup.
+    """
+    try:
+        await asyncio.to_thread(storage.setup)
+    except Exception as e:
+        logger.error(f"Could not set up the {type(storage).__name__}, lookups may be slow or fail. Error: {str(e)}")
+
+
+# Streaming setup
+async def stream_response(file, content_type, accept_ranges=False):
+    """
+    Streaming, range and conditional response for a stored file, see server_host.stream_response.
+    """
+    status, start, stop, headers = plan_file_response(
+        request, file.filename, file.file_id, file.upload_date, file.length, accept_ranges)
+    if status in (304, 416) or request.method == "HEAD":
+        await asyncio.to_thread(file.close)
+        body = b""
+    else:
+        # Without a WSGI environ every backend returns a plain iterator over the range
+        body = run_sync_iterable(await asyncio.to_thread(storage.body, file, start, stop))
+    response = Response(body, status=status, content_type=content_type)
+    response.headers.update(headers)
+    return response
+
+
+# Metadata cache setup
+metadata_cache = MetadataCache(METADATA_CACHE_BYTES, METADATA_CACHE_TTL)
+
+
+# Metrics setup
+async def start_request_timer():
+    g.metrics_started = time.perf_counter()
+
+
+async def record_request(response):
+    observe_request(request._get_current_object(), response, g.get("metrics_started"))
+    return response
+
+
+if METRICS_ENABLED:
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+    cache_gauges(metadata_cache)
+
+
+async def receive_form(uploads):
+    """
+    Parse a multipart/form-data body as it arrives. Field values are returned as a
+    MultiDict; file parts are streamed into the storage and appended to uploads as
+    (field name, filename, upload) so the caller can discard them on failure.
+    A urlencoded body carries fields only and is parsed as a whole.
+    """
+    content_type, options = parse_options_header(request.headers.get("Content-Type", ""))
+    if content_type == "application/x-www-form-urlencoded":
+        return MultiDict(await request.form)
+    if content_type != "multipart/form-data" or "boundary" not in options:
+        abort(400, description="Expected a multipart/form-data body.")
+
+    decoder = MultipartDecoder(options["boundary"].encode())
+    fields = MultiDict()
+    current = None
+    field_data = []
+
+    async def handle_events():
+        nonlocal current, field_data
+        event = decoder.next_event()
+        while not isinstance(event, (Epilogue, NeedData)):
+            if isinstance(event, Field):
+                current, field_data = event, []
+            elif isinstance(event, File):
+                current = event
+                uploads.append((event.name, event.filename, await asyncio.to_thread(storage.new_upload)))
+            elif isinstance(event, Data):
+                if isinstance(current, Field):
+                    field_data.append(event.data)
+                    if not event.more_data:
+                        fields.add(current.name, b"".join(field_data).decode())
+                else:
+                    await asyncio.to_thread(uploads[-1][2].write, event.data)
+            event = decoder.next_event()
+
+    async for data in request.body:
+        decoder.receive_data(data)
+        await handle_events()
+    decoder.receive_data(None)
+    await handle_events()
+    return fields
+
+
+async def discard_uploads(uploads):
+    for _, _, upload in uploads:
+        await asyncio.to_thread(upload.discard)
+
+
+@app.route("/", methods=["GET"])
+async def home():
+    return jsonify('TUF server')
+
+
+@app.route('/metadata/<filename>', methods=['GET', 'HEAD'])
+async def get_metadata(filename):
+    """
+    Retrieve metadata or target files from storage. Metadata is served from the metadata cache.
+    """
+    try:
+        if filename.endswith(".json"):
+            entry = await asyncio.to_thread(load_metadata, storage, metadata_cache, filename)
+            if entry.data is None:
+                abort(404, description=f"Metadata file {filename} not found")
+            status, data, headers = entry.plan_response(request)
+            response = Response(data, status=status, content_type="application/json")
+            response.headers.update(headers)
+            return response
+
+        file = await asyncio.to_thread(storage.find_target, f"targets/{filename}")
+        if not file:
+            abort(404, description=f"Target file {filename} not found")
+        return await stream_response(file, "application/octet-stream", accept_ranges=True)
+    except HTTPException as http_ex:
+        raise http_ex
+    except Exception as e:
+        logging.exception(f"Unexpected error while fetching file. Error: {str(e)}")
+        abort(500, description="Internal server error")
+
+
+@app.route('/<path:filename>', methods=['GET', 'HEAD'])
+async def get_target(filename):
+    """
+    Retrieve target files from storage.
+    """
+    try:
+        file = await asyncio.to_thread(storage.find_target, filename)
+        if not file:
+            logger.error(f"File {filename} not found")
+            abort(404, description=f"Target file {filename} not found")
+        return await stream_response(file, "application/octet-stream", accept_ranges=True)
+    except HTTPException as http_ex:
+        raise http_ex
+    except Exception as e:
+        logging.exception(f"Unexpected error while fetching file. Error: {str(e)}")
+        abort(500, description=str(e))
+
+
+@app.route('/upload', methods=['POST'])
+async def upload_file():
+    """
+    Upload files to storage, with the same form fields and results as server_host.upload_file.
+    """
+    uploads = []
+    try:
+        form = await receive_form(uploads)
+        category = form.get('category')  # "metadata" or "targets"
+        if category not in ["metadata", "targets"]:
+            abort(400, description="Invalid category. Use 'metadata' or 'targets'.")
+
+        file = next(((filename, upload) for name, filename, upload in uploads if name == "file"), None)
+
+        if category == "targets" and file is None:
+            sha256_hash = form.get('sha256', '')
+            filename = form.get('filename')
+            if not SHA256_HEX.match(sha256_hash) or not filename:
+                abort(400, description="Provide a file, or the sha256 and filename of a stored target.")
+            blob = await asyncio.to_thread(storage.find_blob, sha256_hash)
+            if blob is None:
+                abort(404, description=f"No target with sha256 {sha256_hash}")
+            await asyncio.to_thread(storage.link_blob, blob, f"{category}/{sha256_hash}.{filename}")
+            return jsonify({"message": f"File {filename} linked in {category}", "id": str(blob.file_id)}), 200
+
+        if file is None:
+            abort(400, description="Missing file.")
+        filename, upload = file
+
+        if category == "targets":
+            file_id, created = await asyncio.to_thread(store_target, storage, upload, filename)
+            if not created:
+                logger.info(f"Target {filename} already stored, linked it instead")
+                return jsonify({"message": f"File {filename} already in {category}", "id": str(file_id)}), 200
+            return jsonify({"message": f"File {filename} uploaded to {category}", "id": str(file_id)}), 201
+
+        existing_file = await asyncio.to_thread(finalize_metadata, storage, upload, filename)
+        if existing_file:
+            logger.info(f"File with filename {existing_file.filename} already exists. Overwriting...")
+            await asyncio.to_thread(storage.delete, existing_file)
+        metadata_cache.invalidate(metadata_base_name(filename))
+
+        return jsonify({"message": f"File {filename} uploaded to {category}"}), 201
+
+    except HTTPException as http_ex:
+        raise http_ex
+    except Exception as e:
+        logging.exception(f"Unexpected error while uploading file. Error: {str(e)}")
+        abort(500, description=str(e))
+    finally:
+        await discard_uploads(uploads)
+
+
+@app.route('/publish', methods=['POST'])
+async def publish_release():
+    """
+    Publish a release in one streamed request, with the same fields and ordering as
+    server_host.publish_release: the metadata becomes visible, timestamp.json last,
+    only once the whole body has been received.
+    """
+    uploads = []
+    try:
+        form = await receive_form(uploads)
+        metadata_uploads = [(filename, upload) for name, filename, upload in uploads if name == "metadata"]
+        target_uploads = [(filename, upload) for name, filename, upload in uploads if name == "targets"]
+        links = form.getlist("link")
+        linked = check_release([filename for filename, _ in metadata_uploads],
+                               [filename for filename, _ in target_uploads], links)
+
+        seconds = await asyncio.to_thread(
+            publish_files, storage, metadata_cache, metadata_uploads, target_uploads, linked)
+        logger.info(f"Published {len(metadata_uploads)} metadata files and {len(target_uploads) + len(links)} "
+                    f"targets, metadata made visible in {seconds * 1000:.1f} ms")
+
+        return jsonify(release_summary([filename for filename, _ in metadata_uploads],
+                                       [filename for filename, _ in target_uploads], links)), 201
+
+    except HTTPException as http_ex:
+        raise http_ex
+    except Exception as e:
+        logging.exception(f"Unexpected error while publishing. Error: {str(e)}")
+        abort(500, description=str(e))
+    finally:
+        await discard_uploads(uploads)
+
+
+@app.route('/upload/targets/<sha256_hash>', methods=['GET', 'HEAD'])
+async def probe_target(sha256_hash):
+    """
+    Tell an uploader whether a target with this content hash is already stored.
+    """
+    if not SHA256_HEX.match(sha256_hash):
+        abort(400, description="Invalid sha256")
+    blob = await asyncio.to_thread(storage.find_blob, sha256_hash)
+    if blob is None:
+        abort(404, description=f"No target with sha256 {sha256_hash}")
+    return jsonify({"id": str(blob.file_id), "filename": blob.filename})
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    """
+    Metrics of this worker in the Prometheus text format (see server_metrics.py).
+    """
+    if not METRICS_ENABLED:
+        abort(404, description="Metrics are disabled")
+    return Response(render(), content_type=CONTENT_TYPE)
+
+
+@app.route('/repository/info', methods=['GET'])
+async def repository_info():
+    """
+    Example endpoint to get repository details.
+    """
+    info = {
+        "name": "TUF Repository with GridFS",
+        "description": "A TUF-compliant repository using MongoDB GridFS",
+    }
+    return jsonify(info)
+
+
+if __name__ == '__main__':
+    app.run(debug=True, port=8001)
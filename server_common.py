@@ -0,0 +1,385 @@
+"""
+HTTP and GridFS helpers shared by the Flask server (server_host.py) and the
+asyncio server (server_async.py). Nothing here touches MongoDB or a framework
+request global; callers pass the request and response objects in.
+"""
+import gzip
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import timezone
+
+from pymongo import ASCENDING, DESCENDING
+from werkzeug.exceptions import BadRequest
+from werkzeug.http import http_date as format_http_date, quote_etag
+
+try:
+    import zstandard
+except ImportError:  # zstd copies of the metadata are then not served
+    zstandard = None
+
+# Index setup
+# Every lookup filters on filename, an alias or the content hash and takes the newest upload,
+# so each one is a single index seek on one of these indexes.
+FILES_INDEXES = [
+    [("filename", ASCENDING), ("uploadDate", ASCENDING)],
+    [("aliases", ASCENDING), ("uploadDate", ASCENDING)],
+    [("metadata.sha256", ASCENDING), ("uploadDate", ASCENDING)],
+]
+CHUNKS_INDEX = [("files_id", ASCENDING), ("n", ASCENDING)]
+NEWEST_FIRST = [("uploadDate", DESCENDING)]
+
+
+def name_query(filename):
+    return {"filename": filename}
+
+
+def target_query(filename):
+    return {"$or": [{"filename": filename}, {"aliases": filename}]}
+
+
+def blob_query(sha256_hash):
+    # Targets uploaded before hashes were recorded are found by their name
+    return {"$or": [
+        {"metadata.sha256": sha256_hash},
+        {"filename": {"$regex": f"^targets/{sha256_hash}\\."}},
+    ]}
+
+
+def plan_stages(plan):
+    """
+    Flatten a query plan tree into its stage names, e.g. ["LIMIT", "FETCH", "IXSCAN"].
+    """
+    stages = [plan.get("stage", "?")]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages += plan_stages(child)
+    return stages
+
+
+# Conditional request setup
+# Targets are stored as targets/<sha256>.<filename>, so the name already carries the content hash.
+HASHED_TARGET = re.compile(r"^targets/([0-9a-f]{64})\.")
+SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def file_etag(filename, file_id):
+    """
+    Strong ETag for a stored file: the sha256 from a content addressed target name,
+    otherwise the GridFS id, which never changes for a stored file.
+    """
+    match = HASHED_TARGET.match(filename)
+    return match.group(1) if match else str(file_id)
+
+
+def cache_control_for(filename):
+    return IMMUTABLE_CACHE_CONTROL if HASHED_TARGET.match(filename) else "no-cache"
+
+
+def http_date(upload_date):
+    """
+    GridFS upload dates are naive UTC datetimes with milliseconds; HTTP dates have second precision.
+    """
+    if upload_date is None:
+        return None
+    if upload_date.tzinfo is None:
+        upload_date = upload_date.replace(tzinfo=timezone.utc)
+    return upload_date.replace(microsecond=0)
+
+
+def is_not_modified(request, etag, last_modified):
+    """
+    Check the request validators. If-None-Match takes precedence over If-Modified-Since.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def validator_headers(etag, last_modified, cache_control="no-cache"):
+    """
+    Headers with the validators of a response. The default "no-cache" makes intermediate
+    caches revalidate instead of guessing a freshness lifetime from Last-Modified.
+    """
+    headers = {"ETag": quote_etag(etag), "Cache-Control": cache_control}
+    if last_modified:
+        headers["Last-Modified"] = format_http_date(last_modified)
+    return headers
+
+
+def resolve_range(request, length, etag, last_modified):
+    """
+    Work out which part of a file of the given length to send.
+
+    Returns (status, start, stop, headers): 200 for the whole file, 206 for a single
+    "Range: bytes=..." request, or 416 if the range cannot be satisfied. Multi-range
+    requests and a failed If-Range are answered with the whole file.
+    """
+    headers = {"Accept-Ranges": "bytes"}
+    if_range = request.if_range
+    range_valid = if_range.etag is None or if_range.etag == etag
+    if if_range.date is not None:
+        range_valid = last_modified is not None and last_modified <= if_range.date
+
+    if (range_valid and request.range is not None and request.range.units == "bytes"
+            and len(request.range.ranges) == 1):
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{length}"
+            return 416, 0, 0, headers
+        start, stop = byte_range
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{length}"
+        return 206, start, stop, headers
+
+    return 200, 0, length, headers
+
+
+def plan_file_response(request, filename, file_id, upload_date, length, accept_ranges=False):
+    """
+    Work out the response to a GET or HEAD of a stored file before any of it is read.
+
+    Returns (status, start, stop, headers): 304 if the request's validators match,
+    otherwise as resolve_range with accept_ranges, or the whole file. The headers
+    include the validators and the Content-Length of bytes start to stop; the caller
+    only adds the body.
+    """
+    etag = file_etag(filename, file_id)
+    last_modified = http_date(upload_date)
+    validators = validator_headers(etag, last_modified, cache_control_for(filename))
+    if is_not_modified(request, etag, last_modified):
+        return 304, 0, 0, validators
+
+    status, start, stop, headers = 200, 0, length, {}
+    if accept_ranges:
+        status, start, stop, headers = resolve_range(request, length, etag, last_modified)
+    headers.update(validators)
+    headers["Content-Length"] = str(stop - start)
+    return status, start, stop, headers
+
+
+# Streaming setup
+# Number of bytes read from GridFS per iteration when streaming a file out.
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", 256 * 1024))
+
+# Metadata cache setup
+# Upper bound for the total size of cached metadata, in bytes.
+METADATA_CACHE_BYTES = int(os.getenv("METADATA_CACHE_BYTES", 32 * 1024 * 1024))
+# Seconds between checks that an unversioned file (timestamp.json) is still current.
+METADATA_CACHE_TTL = float(os.getenv("METADATA_CACHE_TTL", 2))
+VERSIONED_METADATA = re.compile(r"^\d+\.")
+
+
+# Content encoding setup
+# Precompressed copies published next to a metadata file (see server/metadata_files.py), in
+# order of preference, with the function that restores the original bytes.
+METADATA_ENCODINGS = {"gzip": (".gz", gzip.decompress)}
+if zstandard is not None:
+    METADATA_ENCODINGS = {
+        "zstd": (".zst", lambda data: zstandard.ZstdDecompressor().decompress(data)),
+        **METADATA_ENCODINGS,
+    }
+
+
+def metadata_base_name(filename):
+    """
+    Name of the metadata file a precompressed copy belongs to, e.g. timestamp.json for timestamp.json.gz.
+    """
+    for suffix, _ in METADATA_ENCODINGS.values():
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def negotiate_encoding(request, available):
+    """
+    Pick the content coding for a response from the available ones, or None for the
+    plain bytes. The client's q-values decide; ties go to the server's order.
+    """
+    best, best_quality = None, 0
+    for encoding in METADATA_ENCODINGS:
+        if encoding in available:
+            quality = request.accept_encodings.quality(encoding)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+    if best is not None and request.accept_encodings.quality("identity") > best_quality:
+        return None
+    return best
+
+
+class CachedMetadata:
+    """
+    A metadata file held in memory. data is None for a file that does not exist.
+    encoded maps a content coding to the (data, etag) of a precompressed copy.
+    file_id identifies the stored versions of the file and of its copies together.
+    """
+
+    def __init__(self, data, file_id=None, upload_date=None, immutable=False):
+        self.data = data
+        self.file_id = file_id
+        self.last_modified = http_date(upload_date)
+        self.immutable = immutable
+        self.etag = hashlib.sha256(data).hexdigest() if data is not None else None
+        self.encoded = {}
+        self.checked_at = time.monotonic()
+
+    def add_encoding(self, encoding, data):
+        """
+        Keep a precompressed copy if it decodes to exactly the original bytes, so a copy
+        left over from an earlier publish is never served. Returns whether it was kept.
+        """
+        try:
+            matches = METADATA_ENCODINGS[encoding][1](data) == self.data
+        except Exception:
+            matches = False
+        if matches:
+            self.encoded[encoding] = (data, hashlib.sha256(data).hexdigest())
+        return matches
+
+    def representation(self, request):
+        """
+        Return (data, etag, encoding) of the copy to send for request, encoding None for the plain bytes.
+        """
+        encoding = negotiate_encoding(request, self.encoded)
+        if encoding is None:
+            return self.data, self.etag, None
+        data, etag = self.encoded[encoding]
+        return data, etag, encoding
+
+    def plan_response(self, request):
+        """
+        Return (status, data, headers) for request: the copy it prefers with its
+        validators, or 304 with no data.
+        """
+        data, etag, encoding = self.representation(request)
+        headers = validator_headers(etag, self.last_modified)
+        headers["Vary"] = "Accept-Encoding"
+        if is_not_modified(request, etag, self.last_modified):
+            return 304, b"", headers
+        if encoding is not None:
+            # Precompressed copies are sent as they are stored, the client decodes them
+            headers["Content-Encoding"] = encoding
+        return 200, data, headers
+
+    @property
+    def size(self):
+        size = len(self.data) if self.data is not None else 0
+        return size + sum(len(data) for data, _ in self.encoded.values())
+
+
+class MetadataCache:
+    """
+    LRU cache of metadata files keyed by filename, bounded by the total size in bytes.
+
+    Versioned files (1.root.json, 2.snapshot.json, ...) never change once published
+    and stay cached until evicted. Unversioned files and missing files (such as the
+    next N.root.json a client probes for) are re-checked against MongoDB at most
+    every ttl seconds, which bounds how long another gunicorn worker can keep
+    serving an outdated timestamp.json.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """
+        Return the cached entry for filename, or None if it is absent or needs revalidation.
+        """
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                return None
+            self._entries.move_to_end(filename)
+            if entry.immutable or time.monotonic() - entry.checked_at < self.ttl:
+                return entry
+            return None
+
+    def peek(self, filename):
+        with self._lock:
+            return self._entries.get(filename)
+
+    def put(self, filename, entry):
+        if entry.size > self.max_bytes // 4:
+            return
+        with self._lock:
+            self._discard(filename)
+            self._entries[filename] = entry
+            self._size += entry.size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+
+    def invalidate(self, filename):
+        with self._lock:
+            self._discard(filename)
+
+    def stats(self):
+        """
+        Number of cached entries and their total size in bytes.
+        """
+        with self._lock:
+            return len(self._entries), self._size
+
+    def _discard(self, filename):
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            self._size -= entry.size
+
+
+# Bulk publish setup
+def is_plain_name(filename):
+    """
+    True for a file name without a directory part, as published files must be.
+    """
+    return bool(filename) and filename not in (".", "..") and not any(c in filename for c in "/\\")
+
+
+def check_release(metadata_names, target_names, links):
+    """
+    Check the parts of a bulk publish before anything is stored: the names of the
+    "metadata" and "targets" files and the "link" fields (<sha256>.<filename>).
+    Returns the (sha256, stored name) of each link. Raises BadRequest.
+    """
+    if not metadata_names and not target_names and not links:
+        raise BadRequest("Nothing to publish. Send 'metadata' and 'targets' files or 'link' fields.")
+    for names in (metadata_names, target_names):
+        if not all(is_plain_name(name) for name in names) or len(set(names)) != len(names):
+            raise BadRequest("File names must be unique and must not contain a directory.")
+
+    linked = []
+    for link in links:
+        sha256_hash, _, filename = link.partition(".")
+        if not SHA256_HEX.match(sha256_hash) or not is_plain_name(filename):
+            raise BadRequest(f"Invalid link {link}, use <sha256>.<filename>.")
+        linked.append((sha256_hash, f"targets/{link}"))
+    return linked
+
+
+def release_summary(metadata_names, target_names, links):
+    """
+    Response body of a successful bulk publish.
+    """
+    return {
+        "message": "Release published",
+        "metadata": list(metadata_names),
+        "targets": list(target_names) + [link.partition(".")[2] for link in links],
+    }
+
+
+def publish_order(filename):
+    """
+    Sort key for making the metadata of a release visible: timestamp.json goes last, so
+    the snapshot and targets metadata it points to are in place before clients see it.
+    A file goes after its precompressed copies.
+    """
+    base_name = metadata_base_name(filename)
+    return base_name == "timestamp.json", filename == base_name
@@ -1,24 +1,57 @@
 import logging
 import sys
+import time
 
-from flask import Flask, Response, jsonify, abort, request
+from flask import Flask, Request, Response, jsonify, abort, g, request
 from werkzeug.exceptions import HTTPException
-from pymongo import MongoClient
-from gridfs import GridFS
 import os
 from dotenv import load_dotenv
-import hashlib
+
+from server_common import (
+    METADATA_CACHE_BYTES, METADATA_CACHE_TTL, NEWEST_FIRST, SHA256_HEX, MetadataCache, blob_query, check_release,
+    metadata_base_name, name_query, plan_file_response, plan_stages, release_summary, target_query,
+)
+from server_metrics import CONTENT_TYPE, METRICS_ENABLED, cache_gauges, observe_request, render
+from server_storage import (
+    GridFSStorage, finalize_metadata, load_metadata, open_storage, publish_files, store_target,
+)
 
 load_dotenv()
 app = Flask(__name__)
 
-# MongoDB setup
-MONGO_URI = os.getenv("MONGODB_URL")
-DB_NAME = "tuf_repo"
+# Storage setup
+# STORAGE_BACKEND "gridfs" keeps files in MongoDB at MONGODB_URL, "local" in the
+# STORAGE_DIR directory (see server_storage.py)
+storage = open_storage()
+
+
+# Upload setup
+class UploadRequest(Request):
+    """
+    Request that streams uploaded files into the storage backend while the form is parsed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.storage_uploads = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload = storage.new_upload()
+        self.storage_uploads.append(upload)
+        return upload
+
+    def close(self):
+        for upload in self.storage_uploads:
+            upload.discard()
+        super().close()
+
+
+app.request_class = UploadRequest
+# Largest accepted request body in bytes, werkzeug answers 413 above it
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_UPLOAD_SIZE", 1024 * 1024 * 1024))
+# Most files and fields in one request, a bulk publish sends a whole release
+app.config["MAX_FORM_PARTS"] = int(os.getenv("MAX_FORM_PARTS", 10000))
 
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
-fs = GridFS(db)
 
 # Configure logging
 BASE_DIR = os.path.dirname(os.path.abspath(sys.argv[0]))  # Directory of the executable
@@ -35,30 +68,88 @@ logging.basicConfig(
 )
 logger = logging.getLogger('server_host.py')
 
+
+# Index setup
+try:
+    # Creates the GridFS indexes, or the directories of the local storage
+    storage.setup()
+except Exception as e:
+    logger.error(f"Could not set up the {type(storage).__name__}, lookups may be slow or fail. Error: {str(e)}")
+
+
+# Streaming setup
+def stream_response(file, content_type, accept_ranges=False):
+    """
+    Build a streaming response for a stored file so that memory per download
+    stays constant regardless of the file size. HEAD requests only get the headers.
+
+    With accept_ranges, a single "Range: bytes=..." request is answered with
+    206 Partial Content by seeking into the file. Responses carry an ETag
+    and Last-Modified, and matching conditional requests get 304 Not Modified
+    (see server_common.plan_file_response).
+    """
+    status, start, stop, headers = plan_file_response(
+        request, file.filename, file.file_id, file.upload_date, file.length, accept_ranges)
+    if status in (304, 416) or request.method == "HEAD":
+        file.close()
+        body = iter(())
+    else:
+        body = storage.body(file, start, stop, request.environ)
+    response = Response(body, status=status, content_type=content_type, direct_passthrough=True)
+    response.headers.update(headers)
+    return response
+
+
+# Metadata cache setup
+metadata_cache = MetadataCache(METADATA_CACHE_BYTES, METADATA_CACHE_TTL)
+
+
+# Metrics setup
+def start_request_timer():
+    g.metrics_started = time.perf_counter()
+
+
+def record_request(response):
+    # One context lookup for all the request attributes
+    observe_request(request._get_current_object(), response, g.get("metrics_started"))
+    return response
+
+
+if METRICS_ENABLED:
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+    cache_gauges(metadata_cache)
+
+
 @app.route("/", methods=["GET"])
 def home():
     return jsonify('TUF server')
 
 
-@app.route('/metadata/<filename>', methods=['GET'])
+@app.route('/metadata/<filename>', methods=['GET', 'HEAD'])
 def get_metadata(filename):
     """
-    Retrieve metadata or target files from GridFS.
+    Retrieve metadata or target files from storage. Metadata is served from the metadata cache.
     """
     try:
         # Check if the requested file is metadata
         is_metadata = filename.endswith(".json")
 
-        # Adjust the lookup path based on the type
-        prefix = "metadata" if is_metadata else "targets"
-        file = fs.find_one({"filename": f"{prefix}/{filename}"})
+        if is_metadata:
+            entry = load_metadata(storage, metadata_cache, filename)
+            if entry.data is None:
+                abort(404, description=f"Metadata file {filename} not found")
+            status, data, headers = entry.plan_response(request)
+            response = Response(data, status=status, content_type="application/json")
+            response.headers.update(headers)
+            return response
+
+        file = storage.find_target(f"targets/{filename}")
 
         if not file:
-            abort(404, description=f"{'Metadata' if is_metadata else 'Target'} file {filename} not found")
+            abort(404, description=f"Target file {filename} not found")
 
-        # Set appropriate content type
-        content_type = "application/json" if is_metadata else "application/octet-stream"
-        return Response(file.read(), content_type=content_type)
+        return stream_response(file, "application/octet-stream", accept_ranges=True)
     except HTTPException as http_ex:
         # Allow Flask to handle HTTP-related exceptions
         raise http_ex
@@ -67,19 +158,19 @@ def get_metadata(filename):
         abort(500, description="Internal server error")
 
 
-@app.route('/<path:filename>', methods=['GET'])
+@app.route('/<path:filename>', methods=['GET', 'HEAD'])
 def get_target(filename):
     """
-    Retrieve target files from GridFS.
+    Retrieve target files from storage.
     """
     logger.info(f"Received request for file: {filename}")
     try:
-        file = fs.find_one({"filename": filename})
+        file = storage.find_target(filename)
         if not file:
             logger.error(f"File {filename} not found")
             abort(404, description=f"Target file {filename} not found")
         logger.info(f"File found, returning {filename}")
-        return Response(file.read(), content_type="application/octet-stream")
+        return stream_response(file, "application/octet-stream", accept_ranges=True)
 
     except HTTPException as http_ex:
         # Allow Flask to handle HTTP-related exceptions
@@ -92,33 +183,50 @@ def get_target(filename):
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """
-    Upload files to GridFS. Accepts files via form-data.
+    Upload files to storage. Accepts files via form-data.
+
+    The file is streamed into the storage backend while it is received (see UploadRequest)
+    and only gets its final name, targets/<sha256>.<filename> for targets, once the hash
+    is known.
+
+    Targets are content addressed: if a blob with the same hash is already stored, the
+    upload is dropped and the existing blob is linked under the new name. A target the
+    server already has (see probe_target) can be linked without sending the bytes, by
+    posting "sha256" and "filename" fields instead of a file.
     """
     try:
-        file = request.files['file']
         category = request.form.get('category')  # "metadata" or "targets"
         if category not in ["metadata", "targets"]:
             abort(400, description="Invalid category. Use 'metadata' or 'targets'.")
 
+        if category == "targets" and 'file' not in request.files:
+            sha256_hash = request.form.get('sha256', '')
+            filename = request.form.get('filename')
+            if not SHA256_HEX.match(sha256_hash) or not filename:
+                abort(400, description="Provide a file, or the sha256 and filename of a stored target.")
+            blob = storage.find_blob(sha256_hash)
+            if blob is None:
+                abort(404, description=f"No target with sha256 {sha256_hash}")
+            storage.link_blob(blob, f"{category}/{sha256_hash}.{filename}")
+            return jsonify({"message": f"File {filename} linked in {category}", "id": str(blob.file_id)}), 200
+
+        file = request.files['file']
+        upload = file.stream
+
         if category == "targets":
-            file_data = file.read()
-            filename = file.filename
-            sha256_hash = hashlib.sha256(file_data).hexdigest()
-            hash_filename = f"{category}/{sha256_hash}.{filename}"
-            fs.put(file_data, filename=hash_filename)
-            return jsonify({"message": f"File {file.filename} uploaded to {category}"}), 201
+            file_id, created = store_target(storage, upload, file.filename)
+            if not created:
+                logger.info(f"Target {file.filename} already stored, linked it instead")
+                return jsonify({"message": f"File {file.filename} already in {category}", "id": str(file_id)}), 200
+            return jsonify({"message": f"File {file.filename} uploaded to {category}", "id": str(file_id)}), 201
 
         if category == "metadata":
-            file_data = file.read()
-            filename = f"{category}/{file.filename}"
-
-            # Check if a file with the same name timestamp.json exists
-            existing_file = fs.find_one({"filename": "metadata/timestamp.json"})
+            existing_file = finalize_metadata(storage, upload, file.filename)
             if existing_file:
-                logger.info(f"File with filename metadata/timestamp.json already exists. Overwriting...")
-                fs.delete(existing_file._id)  # Delete the existing file
+                logger.info(f"File with filename {existing_file.filename} already exists. Overwriting...")
+                storage.delete(existing_file)  # Delete the existing file
+            metadata_cache.invalidate(metadata_base_name(file.filename))
 
-            fs.put(file_data, filename=filename)
             return jsonify({"message": f"File {file.filename} uploaded to {category}"}), 201
 
     except HTTPException as http_ex:
@@ -129,6 +237,65 @@ def upload_file():
         abort(500, description=str(e))
 
 
+@app.route('/publish', methods=['POST'])
+def publish_release():
+    """
+    Publish a release in one streamed multipart/form-data request: "targets" and
+    "metadata" file parts, plus "link" fields naming targets the server already has
+    as <sha256>.<filename> (see probe_target).
+
+    Every file is written to the storage under a temporary name while the body is
+    received. Only once the whole body is in are the targets stored and the metadata
+    given their names, timestamp.json last, so a client never sees a timestamp whose
+    snapshot or targets metadata are missing. A rejected or cut-off request publishes
+    nothing.
+    """
+    try:
+        metadata_files = request.files.getlist("metadata")
+        target_files = request.files.getlist("targets")
+        links = request.form.getlist("link")
+        linked = check_release([file.filename for file in metadata_files],
+                               [file.filename for file in target_files], links)
+
+        seconds = publish_files(storage, metadata_cache, [(file.filename, file.stream) for file in metadata_files],
+                                [(file.filename, file.stream) for file in target_files], linked)
+        logger.info(f"Published {len(metadata_files)} metadata files and {len(target_files) + len(links)} targets, "
+                    f"metadata made visible in {seconds * 1000:.1f} ms")
+
+        return jsonify(release_summary([file.filename for file in metadata_files],
+                                       [file.filename for file in target_files], links)), 201
+
+    except HTTPException as http_ex:
+        raise http_ex
+    except Exception as e:
+        logging.exception(f"Unexpected error while publishing. Error: {str(e)}")
+        abort(500, description=str(e))
+
+
+@app.route('/upload/targets/<sha256_hash>', methods=['GET', 'HEAD'])
+def probe_target(sha256_hash):
+    """
+    Tell an uploader whether a target with this content hash is already stored,
+    so it can skip sending the bytes.
+    """
+    if not SHA256_HEX.match(sha256_hash):
+        abort(400, description="Invalid sha256")
+    blob = storage.find_blob(sha256_hash)
+    if blob is None:
+        abort(404, description=f"No target with sha256 {sha256_hash}")
+    return jsonify({"id": str(blob.file_id), "filename": blob.filename})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Metrics of this worker in the Prometheus text format (see server_metrics.py).
+    """
+    if not METRICS_ENABLED:
+        abort(404, description="Metrics are disabled")
+    return Response(render(), content_type=CONTENT_TYPE)
+
+
 @app.route('/repository/info', methods=['GET'])
 def repository_info():
     """
@@ -140,5 +307,31 @@ def repository_info():
     }
     return jsonify(info)
 
+@app.cli.command("explain-queries")
+def explain_queries():
+    """
+    Print the query plan of every GridFS lookup the routes make and flag collection scans.
+    """
+    if not isinstance(storage, GridFSStorage):
+        sys.exit("explain-queries only applies to the gridfs storage backend")
+    db = storage.db
+    sample_hash = "0" * 64
+    queries = [
+        ("metadata file", name_query("metadata/timestamp.json"), None),
+        ("metadata revalidation", name_query("metadata/timestamp.json"), {"_id": 1}),
+        ("target file", target_query(f"targets/{sample_hash}.color_changer.exe"), None),
+        ("target blob by hash", blob_query(sample_hash), {"_id": 1, "filename": 1, "aliases": 1}),
+    ]
+    scans = 0
+    for name, query, projection in queries:
+        explain = db.fs.files.find(query, projection).sort(NEWEST_FIRST).limit(1).explain()
+        stages = plan_stages(explain["queryPlanner"]["winningPlan"])
+        if "COLLSCAN" in stages:
+            scans += 1
+        print(f"{name:<24} {' <- '.join(stages)}{'  COLLECTION SCAN' if 'COLLSCAN' in stages else ''}")
+    if scans:
+        sys.exit(f"{scans} lookup(s) scan the collection, run ensure_indexes()")
+
+
 if __name__ == '__main__':
     app.run(debug=True, port=8001)
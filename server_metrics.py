@@ -0,0 +1,271 @@
+"""
+Metrics for server_host.py and server_async.py in the Prometheus text format, served
+on GET /metrics.
+
+The counters and histograms are plain in-memory objects behind a lock, so recording
+a request costs a few microseconds (see benchmarks/metrics_overhead.py) and needs no
+client library. Each gunicorn or uvicorn worker keeps its own values, so a scrape reports the
+worker that answered it. METRICS_ENABLED=0 turns off the request hooks, the GridFS
+timing and the MongoDB pool listener.
+"""
+import bisect
+import math
+import os
+import threading
+import time
+
+from pymongo import monitoring
+
+from server_common import SHA256_HEX
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY = []
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_sample(name, labels, value):
+    if labels:
+        name += "{" + ",".join(f'{key}="{escape(label)}"' for key, label in labels.items()) + "}"
+    return f"{name} {value}"
+
+
+class Counter:
+    """
+    Value per combination of label values, only ever increased.
+    """
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in items:
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+class Gauge(Counter):
+    """
+    Value that goes up and down, or that collect() returns as {label values: value}
+    at each scrape.
+    """
+    type = "gauge"
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def samples(self):
+        if self.collect is None:
+            yield from super().samples()
+            return
+        for label_values, value in self.collect().items():
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+class Histogram(Counter):
+    """
+    Count of observations per bucket, with their sum.
+    """
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)  # Buckets count values <= their bound
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(label_values, list(counts), total) for label_values, (counts, total) in self._values.items()]
+        for label_values, counts, total in items:
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": "+Inf" if math.isinf(bound) else bound}, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+def render():
+    """
+    All registered metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(format_sample(*sample) for sample in metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+# Request metrics
+REQUESTS = Counter("tuf_http_requests_total", "HTTP requests by route, method and status.",
+                   ("route", "method", "status"))
+REQUEST_SECONDS = Histogram("tuf_http_request_duration_seconds",
+                            "Time until the response headers are ready, by route.", ("route",))
+RESPONSE_BYTES = Counter("tuf_http_response_bytes_total", "Response body bytes by route, per Content-Length.",
+                         ("route",))
+TARGET_DOWNLOADS = Counter("tuf_target_downloads_total",
+                           "GET responses with the start of a target (resumed ranges are not counted).",
+                           ("target",))
+
+
+
+def target_label(filename):
+    """
+    Label of a target in TARGET_DOWNLOADS: its name without the "<sha256>." prefix of
+    the stored name, so every version of a file is counted under one label, e.g.
+    "app.exe" for targets/<sha256>.app.exe.
+    """
+    name = filename.removeprefix("targets/")
+    sha256_hash, dot, plain_name = name.partition(".")
+    return plain_name if dot and SHA256_HEX.match(sha256_hash) else name
+
+
+def downloaded_target(current_request, response):
+    """
+    Label (see target_label) of the target a GET response starts sending, None for
+    anything else. Ranges that resume a download further in are not counted again.
+    """
+    filename = current_request.view_args.get("filename", "")
+    if current_request.endpoint == "get_metadata" and filename.endswith(".json"):
+        return None  # get_metadata serves targets/<filename> for everything else
+    if response.status_code == 206 and not response.headers.get("Content-Range", "").startswith("bytes 0-"):
+        return None
+    return target_label(filename)
+
+
+def observe_request(current_request, response, started):
+    """
+    Count a request, its latency since started (time.perf_counter() when it came in)
+    until the response is ready (a streamed body is sent later) and the bytes its
+    Content-Length announces. Works with Flask and Quart requests alike.
+    """
+    route = current_request.endpoint or "unmatched"
+    status = response.status_code
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route)
+    REQUESTS.inc(route, current_request.method, status)
+    if current_request.method == "HEAD":
+        return
+    content_length = response.content_length
+    if content_length:
+        RESPONSE_BYTES.inc(route, amount=content_length)
+    if route in ("get_target", "get_metadata") and status in (200, 206) and current_request.method == "GET":
+        target = downloaded_target(current_request, response)
+        if target is not None:
+            TARGET_DOWNLOADS.inc(target)
+
+
+def cache_gauges(metadata_cache):
+    """
+    Register gauges for the size of a server's metadata cache.
+    """
+    Gauge("tuf_metadata_cache_entries", "Files in the metadata cache.",
+          collect=lambda: {(): metadata_cache.stats()[0]})
+    Gauge("tuf_metadata_cache_bytes", "Size of the metadata cache in bytes.",
+          collect=lambda: {(): metadata_cache.stats()[1]})
+
+
+# Storage metrics
+STORAGE_SECONDS = Histogram("tuf_storage_operation_seconds",
+                            "Storage lookups (GridFS find_one) and reads (one chunk each), by operation.",
+                            ("backend", "operation"))
+METADATA_CACHE_LOOKUPS = Counter("tuf_metadata_cache_lookups_total",
+                                 "Metadata cache lookups: hit, revalidated (unchanged ids) or miss.", ("result",))
+
+# MongoDB connection pool metrics
+POOL_CONNECTIONS = Gauge("tuf_mongodb_pool_connections", "MongoDB connections by state.", ("state",))
+POOL_CHECKOUT_SECONDS = Histogram("tuf_mongodb_pool_checkout_seconds",
+                                  "Time to check a connection out of the pool, by outcome.", ("outcome",))
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    pymongo pool listener keeping POOL_CONNECTIONS and POOL_CHECKOUT_SECONDS.
+    """
+
+    def connection_created(self, event):
+        POOL_CONNECTIONS.inc("open")
+
+    def connection_closed(self, event):
+        POOL_CONNECTIONS.dec("open")
+
+    def connection_checked_out(self, event):
+        POOL_CONNECTIONS.inc("checked_out")
+        POOL_CHECKOUT_SECONDS.observe(event.duration, "ok")
+
+    def connection_check_out_failed(self, event):
+        POOL_CHECKOUT_SECONDS.observe(event.duration, event.reason)
+
+    def connection_checked_in(self, event):
+        POOL_CONNECTIONS.dec("checked_out")
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+
+class TimedReader:
+    """
+    File handle that records the duration of each read in STORAGE_SECONDS.
+    """
+
+    def __init__(self, handle, backend):
+        self.handle = handle
+        self.backend = backend
+
+    def read(self, size=-1):
+        started = time.perf_counter()
+        try:
+            return self.handle.read(size)
+        finally:
+            STORAGE_SECONDS.observe(time.perf_counter() - started, self.backend, "read")
+
+    def seek(self, offset, whence=0):
+        return self.handle.seek(offset, whence)
+
+    def close(self):
+        self.handle.close()
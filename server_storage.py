@@ -0,0 +1,518 @@
+"""
+Storage backends for server_host.py and server_async.py.
+
+A backend stores metadata/<name> and content addressed targets/<sha256>.<name>
+files and hands them to the routes as StoredFile objects:
+
+* GridFSStorage keeps everything in MongoDB GridFS. Identical targets share one
+  blob, the other names are recorded as aliases.
+* LocalStorage keeps the same layout in a directory. Identical targets are hard
+  links to one file in blobs/<sha256>, and whole files are served through the
+  server's wsgi.file_wrapper, which gunicorn sends with sendfile() so the bytes
+  never pass through Python. It needs no MongoDB, which also makes it a stand-in
+  for local testing.
+
+load_metadata() and publish_files() at the end work on any backend, so both servers
+read and publish the same way.
+"""
+import hashlib
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime, timezone
+
+from gridfs import GridFS
+from pymongo import MongoClient
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+
+from server_common import (
+    CHUNKS_INDEX, FILES_INDEXES, HASHED_TARGET, METADATA_ENCODINGS, NEWEST_FIRST, STREAM_CHUNK_SIZE,
+    VERSIONED_METADATA, CachedMetadata, blob_query, metadata_base_name, name_query, publish_order, target_query,
+)
+from server_metrics import METADATA_CACHE_LOOKUPS, METRICS_ENABLED, STORAGE_SECONDS, PoolMetrics, TimedReader
+
+
+DB_NAME = "tuf_repo"
+
+
+def open_storage():
+    """
+    Open the storage selected by the environment: STORAGE_BACKEND "gridfs" (default,
+    MongoDB at MONGODB_URL) or "local" (the STORAGE_DIR directory).
+    """
+    if os.getenv("STORAGE_BACKEND", "gridfs") == "local":
+        return LocalStorage(os.getenv("STORAGE_DIR", "storage"))
+    if not METRICS_ENABLED:
+        return GridFSStorage(MongoClient(os.getenv("MONGODB_URL"))[DB_NAME])
+    client = MongoClient(os.getenv("MONGODB_URL"), event_listeners=[PoolMetrics()])
+    return GridFSStorage(client[DB_NAME], timed=True)
+
+
+def put_file(storage, filename, data):
+    """
+    Store data under filename, replacing the current version. Readers see the old or
+    the new file, never a partial one.
+    """
+    previous = storage.find(filename)
+    if previous:
+        previous.close()
+    upload = storage.new_upload()
+    upload.write(data)
+    file_id = upload.finalize(filename)
+    if previous:
+        storage.delete(previous)
+    return file_id
+
+
+def iter_file(handle, length, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield length bytes of an open file from its current position in chunks of at
+    most chunk_size bytes, then close it.
+    """
+    remaining = length
+    try:
+        while remaining > 0:
+            chunk = handle.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        handle.close()
+
+
+class StoredFile:
+    """
+    A stored file as the routes see it. handle is an open binary file positioned at
+    the start, or None for lookups that only need the record (find_blob).
+    """
+
+    def __init__(self, filename, file_id, length, upload_date, handle=None, aliases=()):
+        self.filename = filename
+        self.file_id = file_id
+        self.length = length
+        self.upload_date = upload_date
+        self.handle = handle
+        self.aliases = list(aliases)
+
+    def read(self):
+        try:
+            return self.handle.read()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+
+
+# GridFS backend
+class GridFSUpload:
+    """
+    Writable stream that werkzeug's form parser fills with an uploaded file. The bytes
+    go straight into GridFS under a temporary name while the SHA-256 is updated, so an
+    upload is never held in memory or a temporary file. finalize() gives the file its
+    real name once the hash is known; anything not finalized is deleted.
+    """
+
+    def __init__(self, db, fs):
+        self.sha256 = hashlib.sha256()
+        self.length = 0
+        self.finalized = False
+        self._db = db
+        self._fs = fs
+        self._grid_in = fs.new_file(filename=f"uploads/{uuid.uuid4().hex}")
+
+    @property
+    def file_id(self):
+        return self._grid_in._id
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.length += len(data)
+        self._grid_in.write(data)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        # The form parser rewinds the stream once the part is complete
+        return self.length
+
+    def tell(self):
+        return self.length
+
+    def close(self):
+        if not self._grid_in.closed:
+            self._grid_in.close()
+
+    def finalize(self, filename):
+        """
+        Store the remaining buffered bytes and rename the file to filename.
+        """
+        self.close()
+        self._db.fs.files.update_one(
+            {"_id": self.file_id},
+            {"$set": {"filename": filename, "metadata.sha256": self.sha256.hexdigest()}},
+        )
+        self.finalized = True
+        return self.file_id
+
+    def discard(self):
+        if self.finalized:
+            return
+        if self._grid_in.closed:
+            self._fs.delete(self.file_id)
+        else:
+            self._grid_in.abort()
+
+
+class GridFSStorage:
+    """
+    Files in MongoDB GridFS. Several versions of a name may exist; lookups return the newest.
+    With timed, lookups and chunk reads are recorded in server_metrics.STORAGE_SECONDS.
+    """
+
+    def __init__(self, db, timed=False):
+        self.db = db
+        self.fs = GridFS(db)
+        self.timed = timed
+
+    def _find_one(self, find_one, *args, **kwargs):
+        if not self.timed:
+            return find_one(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return find_one(*args, **kwargs)
+        finally:
+            STORAGE_SECONDS.observe(time.perf_counter() - started, "gridfs", "find_one")
+
+    def setup(self):
+        """
+        Create the fs.files and fs.chunks indexes the request paths rely on. GridFS only
+        creates its own indexes on the first write, and never the alias or hash ones.
+        """
+        for keys in FILES_INDEXES:
+            self.db.fs.files.create_index(keys)
+        self.db.fs.chunks.create_index(CHUNKS_INDEX, unique=True)
+
+    def new_upload(self):
+        return GridFSUpload(self.db, self.fs)
+
+    def _open(self, query):
+        grid_out = self._find_one(self.fs.find_one, query, sort=NEWEST_FIRST)
+        if grid_out is None:
+            return None
+        handle = TimedReader(grid_out, "gridfs") if self.timed else grid_out
+        return StoredFile(grid_out.filename, grid_out._id, grid_out.length, grid_out.upload_date, handle)
+
+    def find(self, filename):
+        return self._open(name_query(filename))
+
+    def find_target(self, filename):
+        """
+        Return the file stored under filename, or under an alias when the same
+        content was uploaded with another name.
+        """
+        return self._open(target_query(filename))
+
+    def current_id(self, filename):
+        """
+        Id of the newest file named filename, or None. Reads the id alone.
+        """
+        current = self._find_one(self.db.fs.files.find_one, name_query(filename), {"_id": 1}, sort=NEWEST_FIRST)
+        return current["_id"] if current else None
+
+    def find_blob(self, sha256_hash):
+        """
+        Return the record of a stored target with this content hash, or None.
+        """
+        blob = self._find_one(self.db.fs.files.find_one, blob_query(sha256_hash),
+                              {"_id": 1, "filename": 1, "aliases": 1}, sort=NEWEST_FIRST)
+        if blob is None:
+            return None
+        return StoredFile(blob["filename"], blob["_id"], None, None, aliases=blob.get("aliases", []))
+
+    def link_blob(self, blob, hash_filename):
+        """
+        Make an existing blob available as hash_filename too, without copying its chunks.
+        """
+        if blob.filename != hash_filename and hash_filename not in blob.aliases:
+            self.db.fs.files.update_one({"_id": blob.file_id}, {"$addToSet": {"aliases": hash_filename}})
+
+    def delete(self, stored):
+        self.fs.delete(stored.file_id)
+
+    def body(self, stored, start, stop, environ=None):
+        stored.handle.seek(start)
+        return iter_file(stored.handle, stop - start)
+
+
+# Local filesystem backend
+class LocalUpload:
+    """
+    Upload stream written to uploads/<uuid> under the storage root while it is hashed.
+    finalize() moves it to its real name with an atomic rename, so readers see either
+    the old file or the complete new one.
+    """
+
+    def __init__(self, storage):
+        self.sha256 = hashlib.sha256()
+        self.length = 0
+        self.finalized = False
+        self._storage = storage
+        self._path = os.path.join(storage.root, "uploads", uuid.uuid4().hex)
+        self._file = open(self._path, "wb")
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.length += len(data)
+        self._file.write(data)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        # The form parser rewinds the stream once the part is complete
+        return self.length
+
+    def tell(self):
+        return self.length
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def finalize(self, filename):
+        """
+        Move the upload to filename. A target also becomes the blob for its hash.
+        """
+        self.close()
+        path = self._storage.path(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self._path, path)
+        self.finalized = True
+        match = HASHED_TARGET.match(filename)
+        if match and not os.path.exists(self._storage.blob_path(match.group(1))):
+            self._storage.link(path, self._storage.blob_path(match.group(1)))
+        return LocalStorage.stat_id(os.stat(path))
+
+    def discard(self):
+        if self.finalized:
+            return
+        self.close()
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+
+class LocalStorage:
+    """
+    Files in a directory: <root>/metadata, <root>/targets, <root>/blobs and
+    <root>/uploads for uploads in progress. Each name holds a single version.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def setup(self):
+        for directory in ("metadata", "targets", "blobs", "uploads"):
+            os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+
+    def new_upload(self):
+        return LocalUpload(self)
+
+    def path(self, filename):
+        """
+        Absolute path of a stored name. Raises ValueError for names outside the root.
+        """
+        path = safe_join(self.root, filename)
+        if path is None:
+            raise ValueError(f"Invalid file name {filename}")
+        return path
+
+    def blob_path(self, sha256_hash):
+        return os.path.join(self.root, "blobs", sha256_hash)
+
+    @staticmethod
+    def stat_id(stat):
+        # Inode and modification time change whenever a name is replaced
+        return f"{stat.st_ino:x}{stat.st_mtime_ns:x}"
+
+    @staticmethod
+    def link(source, destination):
+        try:
+            os.link(source, destination)
+        except FileExistsError:
+            pass
+        except OSError:
+            # File systems without hard links get a copy
+            shutil.copyfile(source, destination)
+
+    def _record(self, filename, stat, handle=None):
+        upload_date = datetime.fromtimestamp(stat.st_mtime, timezone.utc).replace(tzinfo=None)
+        return StoredFile(filename, self.stat_id(stat), stat.st_size, upload_date, handle)
+
+    def find(self, filename):
+        try:
+            handle = open(self.path(filename), "rb")
+        except (ValueError, FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
+        # Stat the open file, so the record matches the bytes served even if the name is replaced
+        return self._record(filename, os.fstat(handle.fileno()), handle)
+
+    def find_target(self, filename):
+        # Aliases are hard links, so every name is a plain file
+        return self.find(filename)
+
+    def current_id(self, filename):
+        try:
+            return self.stat_id(os.stat(self.path(filename)))
+        except (ValueError, OSError):
+            return None
+
+    def find_blob(self, sha256_hash):
+        try:
+            stat = os.stat(self.blob_path(sha256_hash))
+        except OSError:
+            return None
+        return self._record(f"blobs/{sha256_hash}", stat)
+
+    def link_blob(self, blob, hash_filename):
+        path = self.path(hash_filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.link(self.path(blob.filename), path)
+
+    def delete(self, stored):
+        """
+        Delete the version of the file that stored refers to. Nothing happens if the
+        name has been replaced since.
+        """
+        if self.current_id(stored.filename) == stored.file_id:
+            os.remove(self.path(stored.filename))
+
+    def body(self, stored, start, stop, environ=None):
+        """
+        Response body for bytes start to stop. A body running to the end of the file is
+        handed to the server's file wrapper, which can send it without copying.
+        """
+        stored.handle.seek(start)
+        if environ is not None and stop == stored.length:
+            return wrap_file(environ, stored.handle, STREAM_CHUNK_SIZE)
+        return iter_file(stored.handle, stop - start)
+
+
+# Metadata cache setup
+def metadata_ids(storage, filename):
+    """
+    Ids of the stored metadata/<filename> and of its precompressed copies, None where absent.
+    """
+    stored_name = f"metadata/{filename}"
+    return tuple(storage.current_id(f"{stored_name}{suffix}")
+                 for suffix in [""] + [suffix for suffix, _ in METADATA_ENCODINGS.values()])
+
+
+def load_metadata(storage, metadata_cache, filename):
+    """
+    Return the CachedMetadata for metadata/<filename> with its precompressed copies,
+    reading the storage only on a cache miss. An expired entry whose stored files are
+    unchanged is revalidated with a lookup of the file ids alone.
+    """
+    entry = metadata_cache.get(filename)
+    if entry is not None:
+        METADATA_CACHE_LOOKUPS.inc("hit")
+        return entry
+
+    stored_name = f"metadata/{filename}"
+    stale = metadata_cache.peek(filename)
+    if stale is not None:
+        if metadata_ids(storage, filename) == stale.file_id:
+            stale.checked_at = time.monotonic()
+            METADATA_CACHE_LOOKUPS.inc("revalidated")
+            return stale
+
+    METADATA_CACHE_LOOKUPS.inc("miss")
+
+    file = storage.find(stored_name)
+    if file:
+        entry = CachedMetadata(file.read(), upload_date=file.upload_date)
+        file_ids = [file.file_id]
+        for encoding, (suffix, _) in METADATA_ENCODINGS.items():
+            copy = storage.find(f"{stored_name}{suffix}")
+            file_ids.append(copy.file_id if copy else None)
+            if copy:
+                entry.add_encoding(encoding, copy.read())
+        entry.file_id = tuple(file_ids)
+        # A versioned file never changes once all its copies are stored. Until then its
+        # copies may still be being published, so it is revalidated like the others.
+        entry.immutable = (bool(VERSIONED_METADATA.match(filename))
+                           and len(entry.encoded) == len(METADATA_ENCODINGS))
+    else:
+        entry = CachedMetadata(None, file_id=(None,) * (len(METADATA_ENCODINGS) + 1))
+    metadata_cache.put(filename, entry)
+    return entry
+
+
+# Publish setup
+def store_target(storage, upload, filename):
+    """
+    Give an uploaded target its content addressed name targets/<sha256>.<filename>. If a
+    blob with the same hash is already stored, the upload is dropped and the blob linked
+    under that name instead. Returns (file id, whether the upload was stored).
+    """
+    sha256_hash = upload.sha256.hexdigest()
+    hash_filename = f"targets/{sha256_hash}.{filename}"
+
+    blob = storage.find_blob(sha256_hash)
+    if blob is not None:
+        upload.discard()
+        storage.link_blob(blob, hash_filename)
+        return blob.file_id, False
+    return upload.finalize(hash_filename), True
+
+
+def finalize_metadata(storage, upload, filename):
+    """
+    Give uploaded metadata its name metadata/<filename>. Returns the file it replaces
+    (timestamp.json, or a compressed copy), which the caller deletes, or None.
+    """
+    existing_file = storage.find(f"metadata/{filename}")
+    if existing_file:
+        existing_file.close()
+    upload.finalize(f"metadata/{filename}")
+    return existing_file
+
+
+def publish_files(storage, metadata_cache, metadata_uploads, target_uploads, linked):
+    """
+    Publish a release whose files have been received: link the stored blobs in linked
+    ((sha256, stored name) pairs, see server_common.check_release), store the target
+    uploads, then give the metadata uploads their names, timestamp.json last. Uploads
+    are (filename, upload) pairs. Raises NotFound for a link to a hash that is not
+    stored, before anything is published. Returns the seconds the metadata took to
+    become visible.
+    """
+    link_blobs = []
+    for sha256_hash, hash_filename in linked:
+        blob = storage.find_blob(sha256_hash)
+        if blob is None:
+            raise NotFound(f"No target with sha256 {sha256_hash}")
+        link_blobs.append((blob, hash_filename))
+
+    # Targets have content addressed names, nothing refers to them until the metadata is visible
+    for blob, hash_filename in link_blobs:
+        storage.link_blob(blob, hash_filename)
+    for filename, upload in target_uploads:
+        store_target(storage, upload, filename)
+
+    started = time.perf_counter()
+    replaced = []
+    for filename, upload in sorted(metadata_uploads, key=lambda item: publish_order(item[0])):
+        existing_file = finalize_metadata(storage, upload, filename)
+        if existing_file:
+            replaced.append(existing_file)
+    for filename, _ in metadata_uploads:
+        metadata_cache.invalidate(metadata_base_name(filename))
+    for existing_file in replaced:
+        storage.delete(existing_file)
+    return time.perf_counter() - started
@@ -0,0 +1,73 @@
+"""
+Updates staged for the next launch.
+
+In background mode (see lanucher.py) the updater downloads a new version while the
+current one runs and keeps it in STAGING_DIR instead of replacing the running
+executable. The launcher swaps it in the next time the app starts, before running
+it, so starting the app never waits for the network.
+"""
+import json
+import os
+import shutil
+
+from install import activate, file_sha256
+
+STAGING_DIR = "staged"
+
+
+def staged_paths(app_name):
+    """
+    Paths of the staged executable and of the manifest recording its hash.
+    """
+    staged_path = os.path.join(STAGING_DIR, app_name)
+    return staged_path, f"{staged_path}.json"
+
+
+def stage_update(new_exe_path, app_name):
+    """
+    Move a verified download to the staging directory, or copy it when it is on
+    another volume. The manifest with its hash is written last, so a copy that was
+    cut short is never installed.
+    """
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    staged_path, manifest_path = staged_paths(app_name)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    sha256, length = file_sha256(new_exe_path), os.path.getsize(new_exe_path)
+    try:
+        os.replace(new_exe_path, staged_path)
+    except OSError:
+        shutil.copy2(new_exe_path, f"{staged_path}.tmp")
+        os.replace(f"{staged_path}.tmp", staged_path)
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump({"sha256": sha256, "length": length}, f)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    print(f"Update staged in {staged_path}, it is installed on the next launch.")
+
+
+def apply_staged_update(app_path):
+    """
+    Install the update staged for the executable at app_path with one rename, keeping
+    the current one for rollback (see install.py). Returns True if an update was installed. A staged file that does
+    not match its manifest is deleted. Raises PermissionError while app_path is running
+    on Windows.
+    """
+    staged_path, manifest_path = staged_paths(os.path.basename(app_path))
+    try:
+        with open(manifest_path) as f:
+            expected = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if not os.path.isfile(staged_path) or file_sha256(staged_path) != expected["sha256"]:
+        print("Discarding a staged update that does not match its manifest.")
+        for path in (staged_path, manifest_path):
+            if os.path.exists(path):
+                os.remove(path)
+        return False
+
+    activate(staged_path, app_path)
+    os.remove(manifest_path)
+    print(f"Installed the staged update of {os.path.basename(app_path)}.")
+    return True
@@ -3,42 +3,51 @@ import logging
 import os
 import sys
 import traceback
-from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+import hashlib
+from glob import glob
 from pathlib import Path
-from urllib import request
+from urllib import parse
 
 # private
-from network_download import CustomFetcher
-from progress_hook import ProgressWindow
-from new_update import launch_update_dialog
+from install import install_path, rejected
+from network_download import CustomFetcher, PerThreadFetcher
+from progress import Progress, run, watch
+from update_check import build_metadata_dir, record_up_to_date
 
-from tuf.api.exceptions import DownloadError, RepositoryError
-from tuf.ngclient import Updater
+from tuf.api.exceptions import DownloadError, DownloadLengthMismatchError, LengthOrHashMismatchError, RepositoryError
+from tuf.ngclient import Updater, UpdaterConfig
+
+try:
+    import bsdiff4
+except ImportError:  # binary patches are optional, full downloads always work
+    bsdiff4 = None
 
 # constants
 DOWNLOAD_DIR = "./downloads"
+PARTIAL_DIR = os.path.join(DOWNLOAD_DIR, "partial")  # Interrupted target downloads resume from here
 CLIENT_EXAMPLE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
-def build_metadata_dir(base_url: str) -> str:
-    """build a unique and reproducible directory name for the repository url"""
-    name = sha256(base_url.encode()).hexdigest()[:8]
-    # TODO: Make this not windows hostile?
-    return f"./client-tuf-metadata/{name}"
-
-
 def init_tofu(base_url: str) -> bool:
     """Initialize local trusted metadata (Trust-On-First-Use) and create a
-    directory for downloads"""
+    directory for downloads. A trusted root that is already there is kept:
+    the Updater moves it forward through signed root updates."""
     metadata_dir = build_metadata_dir(base_url)
 
+    if os.path.isfile(f"{metadata_dir}/root.json"):
+        return True
+
     if not os.path.isdir(metadata_dir):
         os.makedirs(metadata_dir)
 
     root_url = f"{base_url}/metadata/1.root.json"
     try:
-        request.urlretrieve(root_url, f"{metadata_dir}/root.json")
-    except OSError:
+        root = CustomFetcher().download_bytes(root_url, UpdaterConfig().root_max_length)
+        with open(f"{metadata_dir}/root.json", "wb") as f:
+            f.write(root)
+    except (OSError, DownloadError):
         print(f"Failed to download initial root from {root_url}")
         return False
 
@@ -46,16 +55,161 @@ def init_tofu(base_url: str) -> bool:
     return True
 
 
-def download(base_url: str, target: str) -> bool:
+def part_path(info, directory: str) -> str:
+    """
+    Hidden file in directory that a new version of the target is written to before
+    it is renamed into place. The name includes the target hash, so bytes of one
+    version are never resumed into another.
+    """
+    name = info.path.rpartition("/")[2]
+    return os.path.join(directory, f".{name}.{list(info.hashes.values())[0][:16]}.part")
+
+
+def target_url(updater: Updater, info) -> str:
+    """
+    URL of the target, as Updater.download_target builds it. Reads Updater internals,
+    which is why requirements.txt pins tuf.
+    """
+    target_path = info.path
+    if updater._trusted_set.root.consistent_snapshot and updater.config.prefix_targets_with_hash:
+        dirname, sep, basename = target_path.rpartition("/")
+        target_path = f"{dirname}{sep}{list(info.hashes.values())[0]}.{basename}"
+    return f"{updater._target_base_url}{target_path}"
+
+
+def download_into(updater: Updater, info, directory: str, fetcher: CustomFetcher = None) -> str:
+    """
+    Download the target into a hidden file in directory, on the volume it is installed
+    on, and return its path. The bytes are written once and hashed as they arrive, so
+    the verified file can be renamed into place without another copy. A download that
+    was cut short resumes from that file on the next call. fetcher defaults to the
+    updater's.
+    """
+    fetcher = fetcher or updater._fetcher
+    os.makedirs(directory, exist_ok=True)
+    path = part_path(info, directory)
+    for stale_path in glob(os.path.join(directory, f".{info.path.rpartition('/')[2]}.*.part")):
+        if stale_path != path:
+            os.remove(stale_path)  # Left by an interrupted download of an earlier version
+
+    if fetcher.segments > 1:
+        # Concurrent ranges are assembled in a temporary file first
+        return updater.download_target(info, filepath=path)
+
+    digests = {algorithm: hashlib.new(algorithm) for algorithm in info.hashes}
+    length = 0
+    try:
+        for chunk in fetcher.fetch_into(target_url(updater, info), path):
+            length += len(chunk)
+            if length > info.length:
+                raise DownloadLengthMismatchError(f"{info.path} is longer than {info.length} bytes")
+            for digest in digests.values():
+                digest.update(chunk)
+        if length != info.length:
+            raise LengthOrHashMismatchError(f"{info.path} has {length} bytes, expected {info.length}")
+        for algorithm, digest in digests.items():
+            if digest.hexdigest() != info.hashes[algorithm]:
+                raise LengthOrHashMismatchError(f"{info.path} does not match its {algorithm} hash")
+    except (DownloadLengthMismatchError, RepositoryError):
+        os.remove(path)
+        raise
+
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())  # On disk before it replaces the installed version
+    return path
+
+
+def download_delta(updater: Updater, info, current_path: str, directory: str = None, progress: Progress = None):
+    """
+    Try to build the new version of a target from the local copy at current_path and
+    a signed binary patch published as the target "<target>.<sha256[:16]>.patch".
+
+    The patch is verified like any target, and the patched result must match the
+    length and hashes of the new TargetFile. Returns the path of the result in the
+    download directory (or its part_path in directory), or None to fall back to a
+    full download.
+    """
+    if bsdiff4 is None or not current_path or not os.path.isfile(current_path):
+        return None
+
+    with open(current_path, "rb") as f:
+        current = f.read()
+    source_sha256 = hashlib.sha256(current).hexdigest()
+
+    patch_info = updater.get_targetinfo(f"{info.path}.{source_sha256[:16]}.patch")
+    if patch_info is None:
+        return None
+    delta = (patch_info.custom or {}).get("delta", {})
+    if delta.get("source_sha256") != source_sha256 or delta.get("target_sha256") != info.hashes.get("sha256"):
+        return None
+
+    print(f"Downloading patch {patch_info.path} ({patch_info.length} bytes)...")
+    if progress is not None:
+        progress.start(patch_info.length)
+    patch_path = None
+    try:
+        patch_path = updater.download_target(patch_info)
+        with open(patch_path, "rb") as f:
+            new = bsdiff4.patch(current, f.read())
+        info.verify_length_and_hashes(new)
+    except (OSError, ValueError, RepositoryError, DownloadError) as e:
+        print(f"Patch could not be applied, downloading the full target: {e}")
+        return None
+    finally:
+        if patch_path is not None and os.path.exists(patch_path):
+            os.remove(patch_path)
+
+    if directory is None:
+        path = os.path.join(DOWNLOAD_DIR, parse.quote(info.path, ""))
+    else:
+        os.makedirs(directory, exist_ok=True)
+        path = part_path(info, directory)
+    with open(path, "wb") as f:
+        f.write(new)
+        f.flush()
+        os.fsync(f.fileno())  # On disk before it replaces the installed version
+    return path
+
+
+def build_updater(base_url: str, metadata_dir: str):
+    """
+    Return an Updater over the trusted metadata in metadata_dir and the fetcher it uses.
+    """
+    # Initialize updater with a fetcher that does not show progress for metadata
+    metadata_fetcher = CustomFetcher(cache_dir=f"{metadata_dir}/http-cache")
+    updater = Updater(
+        metadata_dir=metadata_dir,
+        metadata_base_url=f"{base_url}/metadata/",
+        target_base_url=f"{base_url}/",
+        target_dir=DOWNLOAD_DIR,
+        # No progress for metadata refresh, unchanged metadata is answered with 304 Not Modified
+        fetcher=metadata_fetcher,
+    )
+    return updater, metadata_fetcher
+
+
+def download(base_url: str, target: str, segments: int = 1, current_path: str = None,
+             interactive: bool = True, download_dir: str = None, cached_paths: list = None) -> str:
     """
     Download the target file using ``ngclient`` Updater.
 
     The Updater refreshes the top-level metadata, gets the target information,
     verifies if the target is already cached, and if not cached,
-    downloads the target file.
+    downloads the target file. With segments > 1, large targets are fetched
+    as that many concurrent byte ranges. If current_path points to the
+    installed version, a signed binary patch is preferred over the full file,
+    and a version rolled back from it (see install.reject) is not downloaded again.
+    With interactive=False the update is downloaded without asking and
+    without a progress window, for background updates.
+
+    For installs, download_dir is the directory the target is installed in: the
+    target is streamed into a hidden file there (see download_into) instead of the
+    download directory, ready to be renamed into place. The target then counts as
+    cached when one of cached_paths, such as the installed file, matches it.
 
     Returns:
-        A boolean indicating if the process was successful.
+        The path of the downloaded target, or None if there is no update or the
+        download failed.
     """
     metadata_dir = build_metadata_dir(base_url)
 
@@ -65,7 +219,7 @@ def download(base_url: str, target: str) -> bool:
             "Trust-On-First-Use or copy trusted root metadata to "
             f"{metadata_dir}/root.json"
         )
-        return False
+        return None
 
     print(f"Using trusted root in {metadata_dir}")
 
@@ -74,14 +228,7 @@ def download(base_url: str, target: str) -> bool:
         os.mkdir(DOWNLOAD_DIR)
 
     try:
-        # Initialize updater with a fetcher that does not show progress for metadata
-        updater = Updater(
-            metadata_dir=metadata_dir,
-            metadata_base_url=f"{base_url}/metadata/",
-            target_base_url=f"{base_url}/",
-            target_dir=DOWNLOAD_DIR,
-            fetcher=CustomFetcher(progress_hook=None),  # No progress for metadata refresh
-        )
+        updater, metadata_fetcher = build_updater(base_url, metadata_dir)
 
         # Refresh metadata (no progress hook here)
         print("Refreshing metadata...")
@@ -93,50 +240,217 @@ def download(base_url: str, target: str) -> bool:
 
         if info is None:
             print(f"Target {target} not found in the repository.")
-            return False
+            return None
 
         # Check if the target is already cached
-        path = updater.find_cached_target(info)
+        if cached_paths is None:
+            path = updater.find_cached_target(info)
+        else:
+            path = next((p for p in cached_paths if updater.find_cached_target(info, p)), None)
         if path:
             print(f"Target is already available in {path}. No update required.")
-            return False
+            # Lets update_check.is_up_to_date answer the next checks until something changes
+            record_up_to_date(base_url, target, path)
+            return None
+
+        # A version that was rolled back from current_path waits for a newer release
+        if current_path and os.path.isfile(current_path) and info.hashes.get("sha256") in rejected(current_path):
+            print(f"Target {target} was rolled back, it is skipped until a newer release.")
+            record_up_to_date(base_url, target, current_path)
+            return None
 
         # Target is not cached; ask user if they want to download it
         print(f"Target {target} is missing and requires downloading.")
-        user_choice = launch_update_dialog()  # Show dialog and wait for user choice
+        # The tkinter windows are only loaded once there is an update to offer
+        from new_update import launch_update_dialog
+        from progress_hook import ProgressWindow
+        user_choice = launch_update_dialog() if interactive else True  # Show dialog and wait for user choice
 
         if user_choice == True:
             print("Proceeding with the update...")
 
-            # Initialize a progress window only after the user chooses to update
-            progress_window = ProgressWindow()
-
-            # Define a callback function for progress updates
-            def progress_callback(progress):
-                progress_window.update(progress)
-                if progress_window.complete:
+            if interactive:
+                # Initialize a progress window only after the user chooses to update
+                progress_window = ProgressWindow()
+
+                # Called from this thread at a bounded rate while the download runs on another
+                def show_progress(progress):
+                    if not progress_window.complete:
+                        progress_window.update(progress.percent, progress.describe())
+            else:
+                show_progress = None
+
+            # Now set the fetcher that counts the target bytes,
+            # reusing the connections opened for the metadata refresh
+            progress = Progress()
+            updater._fetcher = CustomFetcher(progress=progress, resume_dir=PARTIAL_DIR, adaptive=True,
+                                             session=metadata_fetcher.session, segments=segments)
+
+            # Apply a binary patch to the installed version when one is published,
+            # otherwise download the target and display progress
+            def fetch():
+                path = download_delta(updater, info, current_path, download_dir, progress)
+                if path is None:
+                    progress.start(info.length)
+                    path = updater.download_target(info) if download_dir is None else download_into(
+                        updater, info, download_dir)
+                return path
+
+            try:
+                path = run(fetch, progress, show_progress)
+            finally:
+                if interactive:
                     progress_window.close()
-
-            # Now set the fetcher with the progress hook for downloading the target
-            updater._fetcher = CustomFetcher(progress_hook=progress_callback)
-
-            # Download the target and display progress
-            path = updater.download_target(info)
             print(f"Target downloaded and available in {path}.")
-            return True
+            return path
         else:
             print("User chose to skip the update.")
-            return False
+            return None
 
     except (OSError, RepositoryError, DownloadError) as e:
         print(f"Failed to download target {target}: {e}")
         if logging.root.level < logging.ERROR:
             traceback.print_exc()
-        return False
+        return None
 
 
 
 
+def iter_targets(updater: Updater):
+    """
+    Yield every TargetFile the repository lists, loading each delegated targets role
+    (with hashed bins, every bin). ngclient only looks up one path at a time, so this
+    loads the roles through Updater internals; requirements.txt pins tuf for them.
+    """
+    roles = [("targets", "root")]
+    seen = set()
+    while roles:
+        role, parent_role = roles.pop()
+        if role in seen:
+            continue
+        seen.add(role)
+        targets = updater._load_targets(role, parent_role)
+        yield from targets.targets.values()
+        if targets.delegations is not None:
+            if targets.delegations.roles:
+                roles += [(name, role) for name in targets.delegations.roles]
+            if targets.delegations.succinct_roles:
+                roles += [(name, role) for name in targets.delegations.succinct_roles.get_roles()]
+
+
+def matching_targets(updater: Updater, patterns: list) -> dict:
+    """
+    Return {target path: TargetFile} for patterns, which are target paths or fnmatch
+    globs such as "targets/*.dll". Globs are matched against every listed
+    target except binary patches.
+    """
+    found = {}
+    globs = [pattern for pattern in patterns if any(c in pattern for c in "*?[")]
+    for pattern in patterns:
+        if pattern not in globs:
+            info = updater.get_targetinfo(pattern)
+            if info is None:
+                print(f"Target {pattern} not found in the repository.")
+            else:
+                found[info.path] = info
+    if globs:
+        for info in iter_targets(updater):
+            if not (info.custom or {}).get("delta") and any(fnmatch(info.path, glob) for glob in globs):
+                found[info.path] = info
+    return found
+
+
+def download_targets(base_url: str, patterns: list, workers: int = 4, interactive: bool = True,
+                     install_dir: str = None) -> dict:
+    """
+    Bring several targets up to date with a single metadata refresh.
+
+    The targets named by patterns (see matching_targets) that are out of date are
+    downloaded concurrently on workers threads, over the connections of the metadata
+    refresh, with one progress value for all of them. With interactive=False nothing is
+    asked and no progress window is shown.
+
+    Without install_dir, a target is out of date when it is not cached in the download
+    directory yet. With install_dir, it is compared to its installed file (see
+    install.install_path) instead and downloaded with download_into next to it, ready
+    to be renamed into place.
+
+    Returns:
+        {target path: local path} of the downloaded targets, empty when everything is
+        up to date. None when the update was declined or a download failed.
+    """
+    metadata_dir = build_metadata_dir(base_url)
+
+    if not os.path.isfile(f"{metadata_dir}/root.json"):
+        print(f"Trusted local root not found in {metadata_dir}. Use the 'tofu' command first.")
+        return None
+
+    if not os.path.isdir(DOWNLOAD_DIR):
+        os.mkdir(DOWNLOAD_DIR)
+
+    try:
+        updater, metadata_fetcher = build_updater(base_url, metadata_dir)
+        print("Refreshing metadata...")
+        updater.refresh()
+
+        infos = matching_targets(updater, patterns)
+        if install_dir is None:
+            stale = [info for info in infos.values() if updater.find_cached_target(info) is None]
+        else:
+            stale = [info for info in infos.values()
+                     if updater.find_cached_target(info, install_path(info.path, install_dir)) is None]
+        print(f"{len(stale)} of {len(infos)} targets need downloading.")
+        if not stale:
+            return {}
+
+        if interactive:
+            from new_update import launch_update_dialog
+            from progress_hook import ProgressWindow
+            if launch_update_dialog() != True:
+                print("User chose to skip the update.")
+                return None
+            progress_window = ProgressWindow()
+
+            def show_progress(progress):
+                if not progress_window.complete:
+                    progress_window.update(progress.percent, progress.describe())
+        else:
+            progress_window = show_progress = None
+
+        # Each download thread gets its own fetcher, all counting into one total
+        progress = Progress(sum(info.length for info in stale))
+        fetchers = PerThreadFetcher(metadata_fetcher)
+        updater._fetcher = fetchers
+
+        def fetch(info):
+            fetcher = CustomFetcher(progress=progress, resume_dir=PARTIAL_DIR, adaptive=True,
+                                    session=metadata_fetcher.session)
+            fetchers.use(fetcher)
+            if install_dir is None:
+                return updater.download_target(info)
+            return download_into(updater, info, os.path.dirname(install_path(info.path, install_dir)), fetcher)
+
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {pool.submit(fetch, info): info for info in stale}
+            # The progress window is only touched from this thread
+            watch(futures, progress, show_progress)
+        finally:
+            pool.shutdown(cancel_futures=True)
+            if progress_window is not None:
+                progress_window.close()
+
+        downloaded = {futures[future].path: future.result() for future in futures}
+        print(f"Downloaded {len(downloaded)} targets.")
+        return downloaded
+
+    except (OSError, RepositoryError, DownloadError) as e:
+        print(f"Failed to download targets: {e}")
+        if logging.root.level < logging.ERROR:
+            traceback.print_exc()
+        return None
+
+
 def main() -> None:
     """Main TUF Client Example function"""
 
@@ -179,6 +493,35 @@ def main() -> None:
         help="Target file",
     )
 
+    download_parser.add_argument(
+        "-s",
+        "--segments",
+        help="Download large targets as this many concurrent byte ranges",
+        type=int,
+        default=1,
+    )
+
+    # Batch download
+    download_many_parser = sub_command.add_parser(
+        "download-many",
+        help="Download several target files with one metadata refresh",
+    )
+
+    download_many_parser.add_argument(
+        "targets",
+        metavar="TARGET",
+        nargs="+",
+        help="Target file or glob, e.g. 'targets/*.dll'",
+    )
+
+    download_many_parser.add_argument(
+        "-w",
+        "--workers",
+        help="Targets downloaded at the same time",
+        type=int,
+        default=4,
+    )
+
     command_args = client_args.parse_args()
 
     if command_args.verbose == 0:
@@ -197,8 +540,11 @@ def main() -> None:
         if not init_tofu(command_args.url):
             return "Failed to initialize local repository"
     elif command_args.sub_command == "download":
-        if not download(command_args.url, command_args.target):
+        if not download(command_args.url, command_args.target, command_args.segments):
             return f"Failed to download {command_args.target}"
+    elif command_args.sub_command == "download-many":
+        if download_targets(command_args.url, command_args.targets, command_args.workers) is None:
+            return "Nothing downloaded"
     else:
         client_args.print_help()
 
@@ -0,0 +1,83 @@
+"""
+Fast path for the common "no update" case of the updater.
+
+A full check imports TUF and requests, loads and verifies every trusted metadata
+file, and looks for a new root before it asks the server for the timestamp. When the
+last full check found the target up to date, is_up_to_date() answers with the
+standard library alone. The trusted metadata must still be unexpired, the downloaded
+target unchanged since then, and the server's timestamp.json byte for byte the one
+TUF verified at that check. In every other case it returns False and the updater
+runs the full TUF check.
+"""
+import hashlib
+import json
+import os
+import urllib.request
+from datetime import datetime, timezone
+
+UP_TO_DATE_FILE = "up_to_date.json"  # Kept in the metadata directory by record_up_to_date
+CHECK_TIMEOUT = 10  # Seconds
+MAX_TIMESTAMP_LENGTH = 16 * 1024  # Same bound as UpdaterConfig.timestamp_max_length
+
+
+def build_metadata_dir(base_url: str) -> str:
+    """build a unique and reproducible directory name for the repository url"""
+    name = hashlib.sha256(base_url.encode()).hexdigest()[:8]
+    # TODO: Make this not windows hostile?
+    return f"./client-tuf-metadata/{name}"
+
+
+def record_up_to_date(base_url: str, target: str, path: str) -> None:
+    """
+    Remember that a full TUF check found target up to date in path, with the
+    timestamp.json currently trusted.
+    """
+    metadata_dir = build_metadata_dir(base_url)
+    with open(os.path.join(metadata_dir, "timestamp.json"), "rb") as f:
+        timestamp_sha256 = hashlib.sha256(f.read()).hexdigest()
+    stat = os.stat(path)
+    record = {"target": target, "path": path, "stat": [stat.st_size, stat.st_mtime_ns],
+              "timestamp_sha256": timestamp_sha256}
+
+    record_path = os.path.join(metadata_dir, UP_TO_DATE_FILE)
+    with open(f"{record_path}.tmp", "w") as f:
+        json.dump(record, f)
+    os.replace(f"{record_path}.tmp", record_path)
+
+
+def is_expired(metadata_path: str, now: datetime) -> bool:
+    with open(metadata_path, "rb") as f:
+        expires = json.load(f)["signed"]["expires"]
+    return datetime.strptime(expires, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc) <= now
+
+
+def is_up_to_date(base_url: str, target: str) -> bool:
+    """
+    True if nothing changed since a full check found target up to date. Costs one
+    small request and no TUF import. False means "unknown", run the full check.
+    """
+    metadata_dir = build_metadata_dir(base_url)
+    try:
+        with open(os.path.join(metadata_dir, UP_TO_DATE_FILE)) as f:
+            record = json.load(f)
+        stat = os.stat(record["path"])
+        if record["target"] != target or [stat.st_size, stat.st_mtime_ns] != record["stat"]:
+            return False
+
+        # ngclient refuses expired metadata even when nothing changed, leave that to it
+        now = datetime.now(timezone.utc)
+        for name in os.listdir(metadata_dir):
+            if name.endswith(".json") and name != UP_TO_DATE_FILE and is_expired(os.path.join(metadata_dir, name), now):
+                return False
+
+        with open(os.path.join(metadata_dir, "timestamp.json"), "rb") as f:
+            if hashlib.sha256(f.read()).hexdigest() != record["timestamp_sha256"]:
+                return False
+
+        request = urllib.request.Request(f"{base_url}/metadata/timestamp.json",
+                                         headers={"Accept-Encoding": "identity", "Cache-Control": "no-cache"})
+        with urllib.request.urlopen(request, timeout=CHECK_TIMEOUT) as response:
+            remote_timestamp = response.read(MAX_TIMESTAMP_LENGTH + 1)
+        return hashlib.sha256(remote_timestamp).hexdigest() == record["timestamp_sha256"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
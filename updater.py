@@ -1,6 +1,13 @@
+import argparse
 import os
 import shutil
-from tuf_client import init_tofu, download
+import signal
+import subprocess
+import sys
+import time
+from install import KEEP_VERSIONS, activate, install_path, previous_versions, reject, rollback
+from staging import STAGING_DIR, apply_staged_update, stage_update, staged_paths
+from update_check import is_up_to_date
 
 # Configuration for TUF
 METADATA_DIR = "metadata"  # Local directory for TUF metadata
@@ -14,42 +21,160 @@ def initialize_updater(base_url):
     """
     Initialize the TUF Updater for version 5.1.0.
     """
+    # TUF and requests are only imported once the fast check could not rule out an update
+    from tuf_client import init_tofu
     init_tofu(base_url=base_url)
 
 
-def download_update(base_url, target):
+def download_update(base_url, target, interactive=True, stage=False):
     """
-    Download and verify the update using TUF.
+    Download and verify the update using TUF. It is written once, into a hidden file
+    next to where it goes: the install directory, or the staging directory with
+    stage=True. Returns the path of that file, or None if there is no update.
     """
-    download_up = download(base_url=base_url, target=target)
-    if download_up:
-        download_path = os.path.join(DOWNLOAD_DIR, "targets%2f" + APP_NAME)
-        return download_path
+    from tuf_client import download
+    current_exe = os.path.join(os.getcwd(), APP_NAME)
+    # An update that is already staged counts as downloaded
+    cached_paths = [current_exe, staged_paths(APP_NAME)[0]] if stage else [current_exe]
+    return download(base_url=base_url, target=target, current_path=current_exe, interactive=interactive,
+                    download_dir=STAGING_DIR if stage else os.getcwd(), cached_paths=cached_paths)
 
 
 def replace_executable(new_exe_path):
     """
-    Replace the running executable with the updated version.
+    Replace the executable with the verified download at new_exe_path by renaming it
+    into place, so the executable is never missing or half written. The replaced
+    version is kept for rollback_executable().
     """
     current_exe = os.path.join(os.getcwd(), APP_NAME)  # Path to the current color_changer.exe
-    backup_exe = current_exe + ".bak"
-
     try:
-        # Backup the current executable
-        if os.path.exists(backup_exe):
-            os.remove(backup_exe)
-        shutil.move(current_exe, backup_exe)
-
-        # Replace the current executable with the new version
-        shutil.copy2(new_exe_path, current_exe)
+        if os.path.dirname(os.path.abspath(new_exe_path)) != os.path.dirname(current_exe):
+            # Not on the install volume, copy it over once
+            copied_path = f"{current_exe}.new"
+            shutil.copy2(new_exe_path, copied_path)
+            new_exe_path = copied_path
+        activate(new_exe_path, current_exe)
         print("Executable updated successfully.")
     except Exception as e:
         print("Failed to replace the executable.")
         print(e)
 
 
+def rollback_executable():
+    """
+    Put the previous version of the executable back in place. The rolled back version
+    is rejected: the updater skips it until a newer release is published, and an
+    update staged for the next launch is discarded.
+    """
+    current_exe = os.path.join(os.getcwd(), APP_NAME)
+    if not previous_versions(current_exe):
+        print("No previous version to roll back to.")
+        return
+    reject(current_exe)
+    rollback(current_exe)
+    for path in staged_paths(APP_NAME):
+        if os.path.exists(path):
+            os.remove(path)
+    print(f"Rolled back to the previous version, {len(previous_versions(current_exe))} older versions left.")
+
+
+def install_targets(downloads, install_dir=None):
+    """
+    Install downloaded targets together, all or nothing. downloads are the files
+    download_targets(install_dir=...) left next to their destinations (see
+    install.install_path); they are renamed into place one by one, keeping the replaced
+    versions. If one of them cannot be installed, the files already installed are
+    rolled back and the remaining downloads removed. Returns True once all are in place.
+    """
+    install_dir = install_dir or os.getcwd()
+    installed = []  # (destination, whether it replaced a file)
+    try:
+        for target_path, download_path in downloads.items():
+            destination = install_path(target_path, install_dir)
+            existed = os.path.exists(destination)
+            activate(download_path, destination, keep=max(KEEP_VERSIONS, 1))
+            installed.append((destination, existed))
+    except OSError as e:
+        print(f"Failed to install {target_path}, rolling back: {e}")
+        for destination, existed in reversed(installed):
+            try:
+                if existed:
+                    rollback(destination)
+                else:
+                    os.remove(destination)
+            except OSError as rollback_error:
+                print(f"Failed to roll back {destination}: {rollback_error}")
+        for download_path in downloads.values():
+            if os.path.exists(download_path):
+                os.remove(download_path)
+        return False
+    print(f"Installed {len(installed)} files.")
+    return True
+
+
+def restart_application(app_pid):
+    """
+    Stop the running app, install the staged update and start the app again. Returns
+    False if the update could not be installed: the current version is started again
+    and the update stays staged for the next launch.
+    """
+    current_exe = os.path.join(os.getcwd(), APP_NAME)
+    try:
+        os.kill(app_pid, signal.SIGTERM)
+    except OSError:
+        pass  # Already closed
+    # Windows keeps the executable locked until the process has exited
+    for _ in range(50):
+        try:
+            apply_staged_update(current_exe)
+            installed = True
+            break
+        except PermissionError:
+            time.sleep(0.1)
+    else:
+        print(f"{APP_NAME} is still running, the update is installed on its next launch.")
+        installed = False
+    subprocess.Popen([current_exe])
+    return installed
+
+
 if __name__ == "__main__":
-    updater = initialize_updater(BASE_URL)
-    new_exe_path = download_update(BASE_URL, target)
-    if new_exe_path:
+    parser = argparse.ArgumentParser(description="Check for and download an update of the app.")
+    parser.add_argument("--stage", action="store_true",
+                        help="Download without asking and stage the update for the next launch")
+    parser.add_argument("--app-pid", type=int, default=None,
+                        help="With --stage, the running app to offer a restart of once the update is staged")
+    parser.add_argument("--targets", nargs="+", metavar="PATTERN",
+                        help="Update these targets or globs (e.g. 'targets/*.dll') together instead of the app")
+    parser.add_argument("--rollback", action="store_true",
+                        help="Put the previous version of the app back in place")
+    args = parser.parse_args()
+
+    if args.rollback:
+        rollback_executable()
+        sys.exit(0)
+
+    if args.targets:
+        if args.stage:
+            parser.error("--stage only applies to the app")
+        from tuf_client import download_targets
+        initialize_updater(BASE_URL)
+        downloads = download_targets(BASE_URL, args.targets, install_dir=os.getcwd())
+        if downloads is None or not install_targets(downloads):
+            sys.exit(1)
+        sys.exit(0)
+
+    if is_up_to_date(BASE_URL, target):
+        print("No update available.")
+        new_exe_path = None
+    else:
+        updater = initialize_updater(BASE_URL)
+        new_exe_path = download_update(BASE_URL, target, interactive=not args.stage, stage=args.stage)
+    if new_exe_path and args.stage:
+        stage_update(new_exe_path, APP_NAME)
+        if args.app_pid:
+            from new_update import launch_restart_dialog
+            if launch_restart_dialog() and not restart_application(args.app_pid):
+                sys.exit(1)
+    elif new_exe_path:
         replace_executable(new_exe_path)